@@ -0,0 +1,415 @@
+"""Local stand-ins for the Google Drive, Google Photos, GitHub and Gist APIs.
+
+All of them serve the same synthetic account, which is generated
+deterministically from a spec, so consecutive runs see the same data.
+"""
+
+import re
+import json
+import random
+import hashlib
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+MODIFIED_TIME = '2020-01-01T00:00:00.000Z'
+
+
+class Account:
+    """Synthetic account.
+
+    Drive files are spread over a folder tree of the given depth and fanout.
+    Photos are spread over albums, a share of them is in two albums.
+    """
+
+    def __init__(self, spec, git_url):
+        """
+        Constructor
+
+        @param dict spec files, size, depth, fanout, albums, shared, repos, gists
+        @param string git_url URL of the folder holding the bare repositories
+        """
+        self.spec = spec
+        self.git_url = git_url
+        self.content = random.Random(0).randbytes(spec['size'])
+
+        self.drive = {}
+        self.children = {}
+        self.build_drive()
+
+        self.albums = []
+        self.album_items = {}
+        self.build_photos()
+
+        self.repos = ['repo-{:04d}'.format(i) for i in range(spec['repos'])]
+        self.gists = ['gist{:04d}'.format(i) for i in range(spec['gists'])]
+
+    def build_drive(self):
+        """Generate folder tree and files."""
+        folders = ['root']
+        level = ['root']
+
+        for depth in range(self.spec['depth']):
+            next_level = []
+
+            for parent in level:
+                for i in range(self.spec['fanout']):
+                    folder_id = '{}-d{}'.format(parent, i)
+                    self.add_item(folder_id, 'folder-{}-{}'.format(depth, i), parent, FOLDER_MIME_TYPE)
+                    next_level.append(folder_id)
+
+            folders += next_level
+            level = next_level
+
+        for i in range(self.spec['files']):
+            self.add_item('f{:06d}'.format(i), 'file-{:06d}.bin'.format(i), folders[i % len(folders)], 'application/octet-stream')
+
+    def add_item(self, item_id, name, parent, mime_type):
+        """
+        Add Drive item.
+
+        @param string item_id
+        @param string name
+        @param string parent
+        @param string mime_type
+        """
+        self.drive[item_id] = {
+            'id': item_id,
+            'name': name,
+            'mimeType': mime_type,
+            'modifiedTime': MODIFIED_TIME,
+            'trashed': False,
+            'parents': [parent]
+        }
+        self.children.setdefault(parent, []).append(self.drive[item_id])
+
+    def build_photos(self):
+        """Generate albums and media items."""
+        count = max(1, self.spec['albums'])
+        items = [{
+            'id': 'p{:06d}'.format(i),
+            'filename': 'IMG_{:06d}.jpg'.format(i),
+            'mediaMetadata': {'width': '4000', 'height': '3000', 'creationTime': MODIFIED_TIME}
+        } for i in range(self.spec['files'])]
+
+        for i in range(count):
+            album_id = 'a{:04d}'.format(i)
+            self.album_items[album_id] = items[i::count]
+            self.albums.append({'id': album_id, 'title': '2020-01-{:02d} Album {}'.format(i % 28 + 1, i)})
+
+        # Put a share of the items into a second album as well
+        shared = items[:int(len(items) * self.spec['shared'])]
+
+        for i, item in enumerate(shared):
+            self.album_items['a{:04d}'.format((i + 1) % count)].append(item)
+
+        for album in self.albums:
+            album['mediaItemsCount'] = str(len(self.album_items[album['id']]))
+
+    def get_content(self, name):
+        """
+        Get content of a file, unique per name.
+
+        @param string name
+        @return bytes
+        """
+        prefix = hashlib.sha256(name.encode('utf-8')).digest()
+
+        return prefix + self.content[len(prefix):]
+
+
+class Handler(BaseHTTPRequestHandler):
+    """Dispatch requests to the fake APIs."""
+    protocol_version = 'HTTP/1.1'
+    account = None
+    stats = None
+    lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        """Keep quiet."""
+
+    def count(self, service, size=0):
+        """
+        Count request.
+
+        @param string service
+        @param int size Response body size
+        """
+        with self.lock:
+            self.stats['requests'][service] = self.stats['requests'].get(service, 0) + 1
+            self.stats['bytes'] += size
+
+    def send(self, body, status=200, content_type='application/json', headers={}):
+        """
+        Send response.
+
+        @param bytes|dict|list body
+        @param int status (optional)
+        @param string content_type (optional)
+        @param dict headers (optional)
+        """
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode('utf-8')
+
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+
+        for key, value in headers.items():
+            self.send_header(key, value)
+
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_file(self, service, name):
+        """
+        Send file content, honoring range requests.
+
+        @param string service
+        @param string name
+        """
+        content = self.account.get_content(name)
+        match = re.match(r'bytes=(\d+)-', self.headers.get('Range', ''))
+
+        if match:
+            content = content[int(match.group(1)):]
+            self.count(service, len(content))
+            self.send(content, 206, 'application/octet-stream')
+        else:
+            self.count(service, len(content))
+            self.send(content, 200, 'application/octet-stream')
+
+    def send_list(self, service, body, page_url=None):
+        """
+        Send JSON listing, answering conditional requests like GitHub.
+
+        @param string service
+        @param dict|list body
+        @param string page_url (optional) Link to the next page
+        """
+        etag = '"{}"'.format(hashlib.md5(json.dumps(body).encode('utf-8')).hexdigest())
+        headers = {'ETag': etag}
+
+        if page_url:
+            headers['Link'] = '<{}>; rel="next"'.format(page_url)
+
+        if self.headers.get('If-None-Match') == etag:
+            self.count(service)
+            self.send(b'', 304, headers=headers)
+            return
+
+        self.count(service)
+        self.send(body, headers=headers)
+
+    def do_GET(self):
+        """Handle GET requests."""
+        url = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        path = url.path
+
+        if path == '/_stats':
+            self.send(self.stats)
+        elif path.startswith('/drive/v3/'):
+            self.drive(path[len('/drive/v3/'):], query)
+        elif path.startswith('/v1/'):
+            self.photos(path[len('/v1/'):], query)
+        elif path.startswith('/media/'):
+            self.send_file('photos', path[len('/media/'):].split('=')[0])
+        elif path.startswith('/gist-raw/'):
+            self.send_file('gist', path[len('/gist-raw/'):])
+        elif '/gists' in path:
+            self.gists(query)
+        elif path.startswith('/users/') or path.startswith('/repos/'):
+            self.github(path, query)
+        else:
+            self.send({'error': 'not found'}, 404)
+
+    def do_POST(self):
+        """Handle POST requests."""
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8')
+        path = urlparse(self.path).path
+
+        if path == '/v1/mediaItems:search':
+            self.photos('mediaItems:search', {key: values[0] for key, values in parse_qs(body).items()})
+        elif path == '/graphql':
+            self.graphql(json.loads(body)['variables'])
+        elif path == '/token':
+            self.count('token')
+            self.send({'access_token': 'token', 'refresh_token': 'refresh', 'expires_in': 3600})
+        else:
+            self.send({'error': 'not found'}, 404)
+
+    def paginate(self, items, query, default_size):
+        """
+        Get page of items.
+
+        @param list items
+        @param dict query
+        @param int default_size
+        @return tuple Items and next page token
+        """
+        offset = int(query.get('pageToken', 0))
+        size = int(query.get('pageSize', default_size))
+        next_token = str(offset + size) if offset + size < len(items) else None
+
+        return items[offset:offset + size], next_token
+
+    def drive(self, path, query):
+        """
+        Google Drive API.
+
+        @param string path
+        @param dict query
+        """
+        if path == 'changes/startPageToken':
+            self.count('drive')
+            self.send({'startPageToken': '1'})
+        elif path == 'changes':
+            self.count('drive')
+            self.send({'changes': [], 'newStartPageToken': '1'})
+        elif path == 'files/root':
+            self.count('drive')
+            self.send({'id': 'root'})
+        elif path.startswith('files/'):
+            self.send_file('drive', path[len('files/'):])
+        elif path == 'files':
+            match = re.match(r"'(.+)' in parents", query.get('q', ''))
+            items = self.account.children.get(match.group(1), []) if match else list(self.account.drive.values())
+            page, next_token = self.paginate(items, query, 100)
+            body = {'files': page}
+
+            if next_token:
+                body['nextPageToken'] = next_token
+
+            self.count('drive')
+            self.send(body)
+        else:
+            self.send({'error': 'not found'}, 404)
+
+    def photos(self, path, query):
+        """
+        Google Photos API.
+
+        @param string path
+        @param dict query
+        """
+        base_url = 'http://{}:{}/media/'.format(*self.server.server_address)
+
+        if path == 'albums':
+            page, next_token = self.paginate(self.account.albums, query, 50)
+            body = {'albums': page}
+        elif path == 'mediaItems:search':
+            items = [dict(item, baseUrl=base_url + item['id']) for item in self.account.album_items.get(query['albumId'], [])]
+            page, next_token = self.paginate(items, query, 100)
+            body = {'mediaItems': page}
+        else:
+            self.send({'error': 'not found'}, 404)
+            return
+
+        if next_token:
+            body['nextPageToken'] = next_token
+
+        self.count('photos')
+        self.send(body)
+
+    def get_repository(self, name):
+        """
+        Get repository in the format of GitHub's REST API.
+
+        @param string name
+        @return dict
+        """
+        api_url = 'http://{}:{}'.format(*self.server.server_address)
+
+        return {
+            'name': name,
+            'clone_url': '{}/{}.git'.format(self.account.git_url, name),
+            'default_branch': 'master',
+            'pushed_at': MODIFIED_TIME,
+            'tags_url': '{}/repos/user/{}/tags'.format(api_url, name)
+        }
+
+    def github(self, path, query):
+        """
+        GitHub REST API.
+
+        @param string path
+        @param dict query
+        """
+        api_url = 'http://{}:{}'.format(*self.server.server_address)
+        parts = path.strip('/').split('/')
+
+        if parts[0] == 'users' and parts[2] == 'repos':
+            page = int(query.get('page', 1))
+            repos = self.account.repos[(page - 1) * 30:page * 30]
+            next_url = '{}/users/{}/repos?page={}'.format(api_url, parts[1], page + 1) if page * 30 < len(self.account.repos) else None
+            self.send_list('github', [self.get_repository(name) for name in repos], next_url)
+        elif parts[0] == 'repos' and parts[3] == 'tags':
+            self.send_list('github', [{
+                'name': '1.0',
+                'zipball_url': '{}/repos/{}/{}/zipball/refs/tags/1.0'.format(api_url, parts[1], parts[2])
+            }])
+        elif parts[0] == 'repos' and parts[3] == 'zipball':
+            self.send_file('github', parts[2])
+        else:
+            self.send({'error': 'not found'}, 404)
+
+    def graphql(self, variables):
+        """
+        GitHub GraphQL API, only the query for repositories and their latest tag.
+
+        @param dict variables
+        """
+        offset = int(variables.get('after') or 0)
+        names = self.account.repos[offset:offset + 100]
+
+        self.count('github')
+        self.send({'data': {'user': {'repositories': {
+            'pageInfo': {'hasNextPage': offset + 100 < len(self.account.repos), 'endCursor': str(offset + 100)},
+            'nodes': [{
+                'name': name,
+                'url': '{}/{}'.format(self.account.git_url, name),
+                'pushedAt': MODIFIED_TIME,
+                'defaultBranchRef': {'name': 'master'},
+                'refs': {'nodes': [{'name': '1.0'}]}
+            } for name in names]
+        }}}})
+
+    def gists(self, query):
+        """
+        GitHub Gist API.
+
+        @param dict query
+        """
+        api_url = 'http://{}:{}'.format(*self.server.server_address)
+        page = int(query.get('page', 1))
+        gists = self.account.gists[(page - 1) * 30:page * 30]
+        next_url = '{}/users/user/gists?page={}'.format(api_url, page + 1) if page * 30 < len(self.account.gists) else None
+
+        self.send_list('gist', [{
+            'id': gist_id,
+            'updated_at': MODIFIED_TIME,
+            'git_pull_url': '{}/{}.git'.format(self.account.git_url, gist_id),
+            'files': {
+                name: {'filename': name, 'raw_url': '{}/gist-raw/{}/{}'.format(api_url, gist_id, name)}
+                for name in ['main.py', 'README.md']
+            }
+        } for gist_id in gists], next_url)
+
+
+def serve(spec, git_url, queue):
+    """
+    Serve fake APIs until the process is terminated.
+
+    @param dict spec Account spec
+    @param string git_url
+    @param Queue queue Receives the port once the server is listening
+    """
+    Handler.account = Account(spec, git_url)
+    Handler.stats = {'requests': {}, 'bytes': 0}
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    queue.put(server.server_address[1])
+    server.serve_forever()
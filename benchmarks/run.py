@@ -0,0 +1,358 @@
+"""Benchmark strategies against local fake APIs and a fake SSH server.
+
+Runs every selected strategy twice against the same synthetic account:
+the first run starts from scratch, the second one finds everything
+backed up already. Reports wall time, throughput, API calls and peak
+Python memory (tracemalloc) per run.
+
+Usage:
+    python -m benchmarks.run [--files 1000] [--size 65536] [--depth 3] [--fanout 4]
+                             [--option key=value ...] [strategy ...]
+"""
+
+import os
+import json
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import tracemalloc
+import subprocess
+import multiprocessing
+
+import requests
+
+from helpers import util
+import helpers.strategy
+from strategies.googledrive import GoogleDrive
+from strategies.googlephotos import GooglePhotos
+from strategies.github import Github
+from strategies.gist import Gist
+from strategies.server import Server
+
+from benchmarks import fake_api
+
+BIN_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bin')
+
+CREDENTIALS = {
+    'client_id': 'client',
+    'client_secret': 'secret',
+    'redirect_uris': ['http://localhost'],
+    'token_uri': ''
+}
+
+TOKEN = {'access_token': 'token', 'refresh_token': 'refresh'}
+
+
+def parse_args():
+    """Parse command line arguments.
+
+    @return dict
+    """
+    parser = argparse.ArgumentParser(description='Benchmark backup strategies offline.')
+    parser.add_argument('strategies', nargs='*', default=['googledrive', 'googlephotos', 'github', 'gist', 'server', 'server-sync'],
+                        help='Benchmarks to run: googledrive, googlephotos, github, gist, server, server-sync')
+    parser.add_argument('--files', type=int, default=1000, help='Number of files (default: 1000)')
+    parser.add_argument('--size', type=int, default=64 * 1024, help='File size in bytes (default: 65536)')
+    parser.add_argument('--depth', type=int, default=3, help='Depth of the folder tree (default: 3)')
+    parser.add_argument('--fanout', type=int, default=4, help='Subfolders per folder (default: 4)')
+    parser.add_argument('--albums', type=int, default=20, help='Number of photo albums (default: 20)')
+    parser.add_argument('--shared', type=float, default=0.1, help='Share of photos in two albums (default: 0.1)')
+    parser.add_argument('--repos', type=int, default=50, help='Number of repositories (default: 50)')
+    parser.add_argument('--gists', type=int, default=50, help='Number of gists (default: 50)')
+    parser.add_argument('--option', action='append', default=[],
+                        help='Alias setting as key=value (JSON value), e.g. download_workers=8. May be repeated')
+    parser.add_argument('--json', help='Also write results to this file')
+    parser.add_argument('--verbose', action='store_true', help='Show log messages of the strategies')
+
+    return parser.parse_args()
+
+
+def parse_options(options):
+    """Parse key=value options.
+
+    @param list options
+    @return dict
+    """
+    parsed = {}
+
+    for option in options:
+        key, value = option.split('=', 1)
+
+        try:
+            parsed[key] = json.loads(value)
+        except ValueError:
+            parsed[key] = value
+
+    return parsed
+
+
+def create_project(path, verbose):
+    """Set up project folder with schemas, logger config and log folder.
+
+    @param string path
+    @param boolean verbose
+    """
+    os.makedirs(os.path.join(path, 'config'))
+    os.makedirs(os.path.join(path, 'log'))
+    shutil.copytree(os.path.join(util.get_project_path(), 'config', 'schemas'), os.path.join(path, 'config', 'schemas'))
+    shutil.copy(os.path.join(util.get_project_path(), 'config', 'logger.yaml'), os.path.join(path, 'config'))
+
+    # Everything project related goes to the temporary project
+    util.get_project_path = lambda: path
+    os.chdir(path)
+
+    # Configure logging once, quietly unless asked for
+    helpers.strategy.Strategy()
+
+    if not verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+
+
+def create_git_repositories(path, names):
+    """Create bare repositories from one template repository.
+
+    @param string path
+    @param list names
+    """
+    template = os.path.join(path, 'template')
+
+    subprocess.run(['git', 'init', '-q', '-b', 'master', template], check=True)
+
+    with open(os.path.join(template, 'README.md'), 'w') as fout:
+        fout.write('Benchmark\n')
+
+    subprocess.run(['git', '-C', template, 'add', '.'], check=True)
+    subprocess.run(['git', '-C', template, '-c', 'user.name=bench', '-c', 'user.email=bench@localhost',
+                    'commit', '-q', '-m', 'Initial commit'], check=True)
+    subprocess.run(['git', 'clone', '-q', '--bare', template, template + '.git'], check=True)
+
+    for name in names:
+        shutil.copytree(template + '.git', os.path.join(path, name + '.git'))
+
+
+def create_server_tree(path, spec):
+    """Create folder tree served by the fake SSH server.
+
+    @param string path
+    @param dict spec
+    """
+    folders = [path]
+
+    for depth in range(spec['depth']):
+        folders += [os.path.join(folder, 'folder-{}-{}'.format(depth, i)) for folder in folders for i in range(spec['fanout'])]
+
+    for folder in folders:
+        os.makedirs(folder, exist_ok=True)
+
+    account = fake_api.Account(dict(spec, files=0, repos=0, gists=0), '')
+
+    for i in range(spec['files']):
+        with open(os.path.join(folders[i % len(folders)], 'file-{:06d}.bin'.format(i)), 'wb') as fout:
+            fout.write(account.get_content(str(i)))
+
+
+def get_benchmarks(api_url, root, options):
+    """Get alias configs and API URLs of all benchmarks.
+
+    @param string api_url
+    @param string root Folder for backups and fake servers
+    @param dict options Settings applied to all aliases
+    @return dict
+    """
+    google = {'exclude': [], 'credentials': dict(CREDENTIALS, token_uri=api_url + '/token'), 'token': TOKEN}
+    github = {'username': 'user', 'token': 'token', 'archive': True}
+
+    benchmarks = {
+        'googledrive': (GoogleDrive, dict(google, type='googledrive'), {
+            'API_URL': api_url + '/drive/v3/files',
+            'CHANGES_URL': api_url + '/drive/v3/changes'
+        }),
+        'googlephotos': (GooglePhotos, dict(google, type='googlephotos'), {'API_URL': api_url + '/v1'}),
+        'github': (Github, dict(github, type='github'), {'API_URL': api_url}),
+        'gist': (Gist, dict(github, type='gist'), {'API_URL': api_url}),
+        'server': (Server, {
+            'type': 'server',
+            'path': os.path.join(root, 'server'),
+            'ssh_user': 'user',
+            'ssh_host': 'localhost',
+            'ssh_pass': 'pass',
+            'versions': 1,
+            'archive': True,
+            'remote_zip': False,
+            'stream_archive': True,
+            'exclude': []
+        }, {}),
+        'server-sync': (Server, {
+            'type': 'server',
+            'path': os.path.join(root, 'server'),
+            'ssh_user': 'user',
+            'ssh_host': 'localhost',
+            'ssh_pass': 'pass',
+            'versions': 2,
+            'archive': False,
+            'remote_zip': False,
+            'snapshot': True,
+            'exclude': []
+        }, {})
+    }
+
+    for name, (_, entry, _) in benchmarks.items():
+        entry.update(options)
+        entry['backup_path'] = os.path.join(root, 'backups', name)
+
+    return benchmarks
+
+
+def get_stats(api_url):
+    """Get request statistics of the fake APIs.
+
+    @param string api_url
+    @return dict
+    """
+    return requests.get(api_url + '/_stats').json()
+
+
+def run_benchmark(name, strategy_class, entry, attributes, api_url):
+    """Back up alias and measure it.
+
+    @param string name
+    @param class strategy_class
+    @param dict entry Alias config
+    @param dict attributes Strategy attributes to override (e.g. API URLs)
+    @param string api_url
+    @return dict
+    """
+    with open(os.path.join('config', 'config.json'), 'w') as fout:
+        fout.write(json.dumps({'general': {}, name: entry}, indent=4))
+
+    strategy = strategy_class()
+
+    for key, value in attributes.items():
+        setattr(strategy, key, value)
+
+    before = get_stats(api_url)
+    tracemalloc.reset_peak()
+    started = time.monotonic()
+
+    res = strategy.backup(name)
+
+    duration = time.monotonic() - started
+    _, peak = tracemalloc.get_traced_memory()
+    after = get_stats(api_url)
+    metrics = res['metrics']
+
+    return {
+        'benchmark': name,
+        'duration': round(duration, 3),
+        'bytes': metrics['bytes'],
+        'files': metrics['files'],
+        'mib_per_second': round(metrics['bytes'] / 1024 / 1024 / max(duration, 0.001), 1),
+        'files_per_second': round(metrics['files'] / max(duration, 0.001), 1),
+        'api_calls': sum(after['requests'].values()) - sum(before['requests'].values()),
+        'peak_memory': peak,
+        'phases': metrics['phases'],
+        'errors': res['errors'],
+        'warnings': res['warnings']
+    }
+
+
+def print_results(results):
+    """Print results as table.
+
+    @param list results
+    """
+    columns = ['Benchmark', 'Run', 'Seconds', 'MiB/s', 'Files/s', 'Files', 'API calls', 'Peak MiB', 'Errors']
+    rows = [[
+        res['benchmark'],
+        res['run'],
+        '{:.2f}'.format(res['duration']),
+        '{:.1f}'.format(res['mib_per_second']),
+        '{:.1f}'.format(res['files_per_second']),
+        res['files'],
+        res['api_calls'],
+        '{:.1f}'.format(res['peak_memory'] / 1024 / 1024),
+        res['errors']
+    ] for res in results]
+
+    widths = [max(len(str(value)) for value in column) for column in zip(columns, *rows)]
+
+    for row in [columns] + rows:
+        print('  '.join(str(value).ljust(width) for value, width in zip(row, widths)))
+
+
+def main():
+    """Run benchmarks."""
+    args = parse_args()
+    args.json = os.path.abspath(args.json) if args.json else None
+    options = parse_options(args.option)
+    spec = {
+        'files': args.files,
+        'size': args.size,
+        'depth': args.depth,
+        'fanout': args.fanout,
+        'albums': args.albums,
+        'shared': args.shared,
+        'repos': args.repos,
+        'gists': args.gists
+    }
+
+    root = tempfile.mkdtemp(prefix='backup-benchmark-')
+    repo_tmp_path = os.path.join(util.get_project_path(), 'tmp')
+    keep_tmp_path = os.path.isdir(repo_tmp_path)
+
+    # Fake ssh and sshpass take precedence
+    os.environ['PATH'] = BIN_PATH + os.pathsep + os.environ['PATH']
+
+    git_path = os.path.join(root, 'git')
+    os.makedirs(git_path)
+    create_git_repositories(git_path, ['repo-{:04d}'.format(i) for i in range(args.repos)] + ['gist{:04d}'.format(i) for i in range(args.gists)])
+    create_server_tree(os.path.join(root, 'server'), spec)
+
+    # Serve APIs from another process, so they don't compete for the GIL
+    queue = multiprocessing.Queue()
+    server = multiprocessing.Process(target=fake_api.serve, args=(spec, 'file://' + git_path, queue), daemon=True)
+    server.start()
+    api_url = 'http://127.0.0.1:{}'.format(queue.get(timeout=60))
+
+    create_project(os.path.join(root, 'project'), args.verbose)
+    benchmarks = get_benchmarks(api_url, root, options)
+
+    if 'server-sync' in args.strategies and not shutil.which('rsync'):
+        print('rsync is not installed, skipping server-sync')
+        args.strategies.remove('server-sync')
+
+    results = []
+    tracemalloc.start()
+
+    try:
+        for name in args.strategies:
+            if name not in benchmarks:
+                print('Unknown benchmark "{}"'.format(name))
+                continue
+
+            strategy_class, entry, attributes = benchmarks[name]
+
+            for run in ['cold', 'warm']:
+                res = run_benchmark(name, strategy_class, entry, attributes, api_url)
+                res['run'] = run
+                results.append(res)
+    finally:
+        tracemalloc.stop()
+        server.terminate()
+        os.chdir(os.path.dirname(root))
+        shutil.rmtree(root, ignore_errors=True)
+
+        if not keep_tmp_path:
+            shutil.rmtree(repo_tmp_path, ignore_errors=True)
+
+    print_results(results)
+
+    if args.json:
+        with open(args.json, 'w') as fout:
+            fout.write(json.dumps({'spec': spec, 'options': options, 'results': results}, indent=4))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+"""Archive helper."""
+
+import shlex
+import shutil
+import subprocess
+
+from helpers import compression
+
+# Archive formats and the compression they use
+FORMATS = {
+    'zip': None,
+    'tar': 'none',
+    'tar.gz': 'gzip',
+    'tar.zst': 'zstd'
+}
+
+
+def get_extension(fmt):
+    """
+    Get file extension for archive format.
+
+    @param string fmt
+    @return string
+    """
+    return '.' + fmt
+
+
+def make_archive(base_name, root_dir, fmt='zip', level=None, threads=None):
+    """
+    Create archive from folder.
+
+    tar archives are compressed while being written, using all cores
+    unless the number of threads is set.
+
+    @param string base_name Path without extension
+    @param string root_dir
+    @param string fmt 'zip', 'tar', 'tar.gz' or 'tar.zst'
+    @param int level (optional) Compression level
+    @param int threads (optional) Number of threads
+    @return string Path of archive
+    @raises Exception
+    """
+    if fmt not in FORMATS:
+        raise Exception('Unknown archive format "{}"'.format(fmt))
+
+    if fmt == 'zip':
+        return shutil.make_archive(base_name, 'zip', root_dir)
+
+    destination = base_name + get_extension(fmt)
+
+    try:
+        compression.pipe_to_file('tar -C {} -cf - .'.format(shlex.quote(root_dir)), destination, FORMATS[fmt], level, threads)
+    except subprocess.CalledProcessError as err:
+        raise Exception('Error archiving: {} STDOUT: {})'.format(err.stderr.decode('utf-8'), err.stdout.decode('utf-8'))) from err
+
+    return destination
@@ -1,5 +1,10 @@
 """Cache helper."""
 
+import os
+import json
+import time
+import sqlite3
+import threading
 from pathlib import Path
 
 from . import util
@@ -7,16 +12,370 @@ from .config import ConfigHelper
 
 
 class Cache(ConfigHelper):
-    """Cache helper."""
+    """Cache helper.
 
-    def __init__(self, namespace):
+    Changes are kept in memory and written back in batches: once
+    batch_size changes have piled up, once flush_interval seconds have
+    passed since the last write or when flush() is called explicitly.
+    """
+    indent = None
+
+    def __init__(self, namespace, flush_interval=30, batch_size=1000):
         """
         Constructor
 
         @param string namespace
+        @param int flush_interval (optional) Seconds between writes
+        @param int batch_size (optional) Number of changes that trigger a write
         """
         # Determine cache location
         location = Path(util.get_project_path()).joinpath(
             'cache', '{}.json'.format(namespace))
+        location.parent.mkdir(parents=True, exist_ok=True)
+
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.pending = 0
+        self.last_flush = time.monotonic()
+        self.lock = threading.RLock()
+
+        super().__init__(write_through=False, location=location)
+
+    def set(self, path, value):
+        """
+        Add value to cache at path.
+
+        @param string path
+        @param string value
+        """
+        with self.lock:
+            super().set(path, value)
+            self.changed()
+
+    def delete(self, path):
+        """
+        Delete entry from cache.
+
+        @param string path
+        """
+        with self.lock:
+            super().delete(path)
+            self.changed()
+
+    def changed(self):
+        """
+        Register a change and write back if due.
+        """
+        self.pending += 1
+
+        if self.pending >= self.batch_size or \
+                time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Write pending changes to file.
+        """
+        with self.lock:
+            if self.pending:
+                self.write()
+
+            self.pending = 0
+            self.last_flush = time.monotonic()
+
+
+class SQLiteCache:
+    """Metadata index backed by an embedded SQLite database.
+
+    Every item is stored under its id (e.g. a Drive file id or a Dropbox path)
+    with indexed lookups by id, path and last_seen. Fields that have no column
+    of their own are kept as JSON in the 'data' column. Changes are committed
+    in batches, like the JSON cache.
+    """
+    COLUMNS = ['path', 'modified', 'hash', 'size', 'last_seen']
+
+    def __init__(self, namespace, flush_interval=30, batch_size=1000, legacy_format='items'):
+        """
+        Constructor
+
+        @param string namespace
+        @param int flush_interval (optional) Seconds between commits
+        @param int batch_size (optional) Number of changes that trigger a commit
+        @param string legacy_format (optional) Shape of the JSON cache to import, see migrate()
+        """
+        cache_path = Path(util.get_project_path()).joinpath('cache')
+        cache_path.mkdir(parents=True, exist_ok=True)
+
+        self.location = cache_path.joinpath('{}.db'.format(namespace))
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.pending = 0
+        self.last_flush = time.monotonic()
+        self.lock = threading.RLock()
+
+        self.db = sqlite3.connect(str(self.location), check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS items (
+                id TEXT PRIMARY KEY,
+                path TEXT,
+                modified TEXT,
+                hash TEXT,
+                size INTEGER,
+                last_seen TEXT,
+                data TEXT
+            );
+            CREATE INDEX IF NOT EXISTS items_path ON items (path);
+            CREATE INDEX IF NOT EXISTS items_last_seen ON items (last_seen);
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            );
+        ''')
+
+        # Import cache from before the switch to SQLite
+        self.migrate(cache_path.joinpath('{}.json'.format(namespace)), legacy_format)
+
+    def migrate(self, json_location, legacy_format='items'):
+        """
+        One-shot import of a JSON cache file.
+
+        The format has to be known up front, because field names can't be
+        told apart from the extensions of dotted keys:
+        'items' maps ids to dicts of fields (e.g. Google Drive),
+        'hashes' maps paths to hashes, with dotted paths stored as
+        nested objects (e.g. Dropbox).
+
+        The JSON file is renamed afterwards so it is only imported once.
+
+        @param Path json_location
+        @param string legacy_format (optional) 'items' or 'hashes'
+        """
+        if not json_location.is_file():
+            return
+
+        try:
+            with open(json_location, 'r') as fin:
+                entries = json.load(fin)
+        except ValueError:
+            entries = {}
+
+        items = []
+
+        def collect(key, value):
+            if isinstance(value, dict):
+                # Dotted keys have been stored as nested objects
+                for sub_key, sub_value in value.items():
+                    collect(key + '.' + sub_key, sub_value)
+            else:
+                items.append((key, {'hash': value}))
+
+        for key, value in entries.items():
+            if legacy_format == 'hashes':
+                collect(key, value)
+            elif isinstance(value, dict):
+                items.append((key, value))
+
+        with self.lock:
+            self.set_many(items)
+            self.flush()
+
+        json_location.rename(json_location.with_suffix('.json.migrated'))
+
+    def to_dict(self, row):
+        """
+        Convert row to item dict.
+
+        @param sqlite3.Row row
+        @return dict
+        """
+        if row is None:
+            return None
+
+        item = {key: row[key] for key in ['id'] + self.COLUMNS if row[key] is not None}
+
+        if row['data']:
+            item.update(json.loads(row['data']))
+
+        return item
+
+    def get(self, item_id, default=None):
+        """
+        Get item by id.
+
+        @param string item_id
+        @param any default (optional)
+        @return dict
+        """
+        with self.lock:
+            row = self.db.execute('SELECT * FROM items WHERE id = ?', (item_id,)).fetchone()
+
+        return self.to_dict(row) if row else default
+
+    def find(self, path):
+        """
+        Get item by path.
+
+        @param string path
+        @return dict
+        """
+        with self.lock:
+            row = self.db.execute('SELECT * FROM items WHERE path = ?', (str(path),)).fetchone()
+
+        return self.to_dict(row)
+
+    def get_stale(self, run):
+        """
+        Get all items that have not been seen in the given run.
+
+        @param string run
+        @return list
+        """
+        with self.lock:
+            rows = self.db.execute(
+                'SELECT * FROM items WHERE last_seen < ? OR last_seen > ? OR last_seen IS NULL',
+                (run, run)).fetchall()
+
+        return [self.to_dict(row) for row in rows]
+
+    def count(self):
+        """
+        Get number of items.
+
+        @return int
+        """
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM items').fetchone()[0]
+
+    def set(self, item_id, **fields):
+        """
+        Insert or update item.
+
+        @param string item_id
+        @param any **fields
+        """
+        self.set_many([(item_id, fields)])
+
+    def set_many(self, items):
+        """
+        Insert or update multiple items in one transaction.
+
+        @param list items List of (item_id, fields) tuples
+        """
+        with self.lock:
+            for item_id, fields in items:
+                columns = {key: value for key, value in fields.items() if key in self.COLUMNS}
+                extra = {key: value for key, value in fields.items() if key not in self.COLUMNS}
+
+                if extra:
+                    row = self.db.execute('SELECT data FROM items WHERE id = ?', (item_id,)).fetchone()
+                    data = json.loads(row['data']) if row and row['data'] else {}
+                    data.update(extra)
+                    columns['data'] = json.dumps(data)
+
+                names = ['id'] + list(columns)
+                update = ', '.join('{0} = excluded.{0}'.format(name) for name in columns)
+
+                self.db.execute('INSERT INTO items ({}) VALUES ({}) ON CONFLICT (id) DO {}'.format(
+                    ', '.join(names),
+                    ', '.join('?' * len(names)),
+                    'UPDATE SET ' + update if update else 'NOTHING'),
+                    [item_id] + list(columns.values()))
+
+            self.changed(len(items))
+
+    def delete(self, item_id):
+        """
+        Delete item.
+
+        @param string item_id
+        """
+        self.delete_many([item_id])
+
+    def delete_many(self, item_ids):
+        """
+        Delete multiple items in one transaction.
+
+        @param list item_ids
+        """
+        with self.lock:
+            self.db.executemany('DELETE FROM items WHERE id = ?', [(item_id,) for item_id in item_ids])
+            self.changed(len(item_ids))
+
+    def move_path(self, old_path, new_path):
+        """
+        Update paths of all items at or below a path (e.g. a moved folder).
+
+        @param string old_path
+        @param string new_path
+        """
+        old_path = str(old_path)
+        prefix = os.path.join(old_path, '')
+
+        with self.lock:
+            self.db.execute('UPDATE items SET path = ? || substr(path, ?) WHERE path = ? OR substr(path, 1, ?) = ?',
+                            (str(new_path), len(old_path) + 1, old_path, len(prefix), prefix))
+            self.changed()
+
+    def delete_path(self, path):
+        """
+        Delete all items at or below a path (e.g. a removed folder).
+
+        @param string path
+        """
+        path = str(path)
+        prefix = os.path.join(path, '')
+
+        with self.lock:
+            self.db.execute('DELETE FROM items WHERE path = ? OR substr(path, 1, ?) = ?',
+                            (path, len(prefix), prefix))
+            self.changed()
+
+    def get_meta(self, key, default=None):
+        """
+        Get meta value (e.g. sync tokens).
+
+        @param string key
+        @param any default (optional)
+        @return any
+        """
+        with self.lock:
+            row = self.db.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+
+        return json.loads(row['value']) if row else default
+
+    def set_meta(self, key, value):
+        """
+        Set meta value.
+
+        @param string key
+        @param any value
+        """
+        with self.lock:
+            self.db.execute('INSERT INTO meta (key, value) VALUES (?, ?) ON CONFLICT (key) DO UPDATE SET value = excluded.value',
+                            (key, json.dumps(value)))
+            self.changed()
+
+    def changed(self, count=1):
+        """
+        Register changes and commit if due.
+
+        @param int count (optional)
+        """
+        self.pending += count
+
+        if self.pending >= self.batch_size or \
+                time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Commit pending changes.
+        """
+        with self.lock:
+            self.db.commit()
 
-        super().__init__(location=location)
+            self.pending = 0
+            self.last_flush = time.monotonic()
@@ -0,0 +1,252 @@
+"""Content-addressed store for deduplicating backup versions."""
+
+import os
+import json
+import zlib
+import hashlib
+import threading
+from collections import Counter
+from datetime import datetime
+
+# Ingesting and collecting garbage must not interleave
+lock = threading.RLock()
+
+class ChunkStore:
+    """
+    Store files as content-defined chunks, each unique chunk only once.
+
+    Files are cut at line ends, so that an insertion only changes the chunks
+    around it. Whether a line end becomes a cut point only depends on the
+    bytes in front of it, which makes boundaries resynchronize after a change.
+    Every stored version is described by a manifest listing its chunks.
+    """
+    FOLDER = '.chunks'
+    MANIFEST_SUFFIX = '.manifest.json'
+    WINDOW = 64
+
+    def __init__(self, path, min_size=256 * 1024, avg_size=1024 * 1024, max_size=4 * 1024 * 1024):
+        """
+        Constructor.
+
+        @param string path Folder to store chunks in
+        @param int min_size
+        @param int avg_size
+        @param int max_size
+        """
+        self.path = path
+        self.min_size = min_size
+        self.avg_size = avg_size
+        self.max_size = max_size
+
+    def find_cut(self, data):
+        """
+        Find the end of the next chunk.
+
+        A line end is chosen with a probability proportional to the length
+        of the line, which keeps the average chunk size independent of it.
+
+        @param bytes data
+        @return int
+        """
+        if len(data) <= self.min_size:
+            return len(data)
+
+        end = min(len(data), self.max_size)
+        previous = data.rfind(b'\n', 0, self.min_size)
+
+        while True:
+            candidate = data.find(b'\n', max(previous + 1, self.min_size), end)
+
+            if candidate == -1:
+                return end
+
+            window = data[max(0, candidate + 1 - self.WINDOW):candidate + 1]
+
+            if zlib.crc32(window) * self.avg_size < (candidate - previous) << 32:
+                return candidate + 1
+
+            previous = candidate
+
+    def chunk(self, fin):
+        """
+        Split stream into content-defined chunks.
+
+        @param file fin
+        @return generator
+        """
+        buffer = b''
+
+        while True:
+            data = fin.read(self.max_size)
+
+            if not data:
+                break
+
+            buffer += data
+
+            while len(buffer) >= self.max_size:
+                cut = self.find_cut(buffer)
+                yield buffer[:cut]
+                buffer = buffer[cut:]
+
+        while buffer:
+            cut = self.find_cut(buffer)
+            yield buffer[:cut]
+            buffer = buffer[cut:]
+
+    def get_chunk_path(self, checksum):
+        """
+        Get path of chunk.
+
+        @param string checksum
+        @return string
+        """
+        return os.path.join(self.path, checksum[:2], checksum)
+
+    def put(self, data):
+        """
+        Store chunk unless already known.
+
+        @param bytes data
+        @return tuple Checksum and whether the chunk was new
+        """
+        checksum = hashlib.sha256(data).hexdigest()
+        path = self.get_chunk_path(checksum)
+
+        if os.path.exists(path):
+            return checksum, False
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        with open(path + '.tmp', 'wb') as fout:
+            fout.write(data)
+
+        os.replace(path + '.tmp', path)
+
+        return checksum, True
+
+    def ingest(self, source, manifest_path):
+        """
+        Store file or folder and write its manifest.
+
+        @param string source
+        @param string manifest_path
+        @return dict Statistics
+        """
+        manifest = {
+            'created': datetime.now().isoformat(),
+            'folders': [],
+            'links': [],
+            'files': []
+        }
+        stats = {'files': 0, 'bytes': 0, 'new_bytes': 0}
+
+        parent = os.path.dirname(os.path.abspath(source))
+
+        if os.path.isdir(source) and not os.path.islink(source):
+            paths = []
+
+            for root, folders, files in os.walk(source):
+                manifest['folders'].append(os.path.relpath(root, parent))
+                paths += [os.path.join(root, name) for name in folders + files if os.path.islink(os.path.join(root, name)) or not os.path.isdir(os.path.join(root, name))]
+        else:
+            paths = [source]
+
+        with lock:
+            for path in sorted(paths):
+                name = os.path.relpath(path, parent)
+
+                if os.path.islink(path):
+                    manifest['links'].append({'path': name, 'target': os.readlink(path)})
+                    continue
+
+                stat = os.stat(path)
+                chunks = []
+
+                with open(path, 'rb') as fin:
+                    for data in self.chunk(fin):
+                        checksum, new = self.put(data)
+                        chunks.append(checksum)
+
+                        if new:
+                            stats['new_bytes'] += len(data)
+
+                manifest['files'].append({
+                    'path': name,
+                    'size': stat.st_size,
+                    'mode': stat.st_mode & 0o7777,
+                    'modified': stat.st_mtime,
+                    'chunks': chunks
+                })
+
+                stats['files'] += 1
+                stats['bytes'] += stat.st_size
+
+            with open(manifest_path + '.tmp', 'w') as fout:
+                fout.write(json.dumps(manifest))
+
+            os.replace(manifest_path + '.tmp', manifest_path)
+
+        return stats
+
+    def restore(self, manifest_path, destination):
+        """
+        Restore version described by manifest into folder.
+
+        @param string manifest_path
+        @param string destination
+        """
+        with open(manifest_path, 'r') as fin:
+            manifest = json.load(fin)
+
+        for folder in manifest['folders']:
+            os.makedirs(os.path.join(destination, folder), exist_ok=True)
+
+        for entry in manifest['files']:
+            path = os.path.join(destination, entry['path'])
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+            with open(path, 'wb') as fout:
+                for checksum in entry['chunks']:
+                    with open(self.get_chunk_path(checksum), 'rb') as fin:
+                        data = fin.read()
+
+                    if hashlib.sha256(data).hexdigest() != checksum:
+                        raise Exception('Chunk {} of {} is corrupt'.format(checksum, entry['path']))
+
+                    fout.write(data)
+
+            os.chmod(path, entry['mode'])
+            os.utime(path, (entry['modified'], entry['modified']))
+
+        for entry in manifest['links']:
+            os.symlink(entry['target'], os.path.join(destination, entry['path']))
+
+    def collect_garbage(self, manifest_folder):
+        """
+        Remove all chunks not referenced by any manifest in folder.
+
+        @param string manifest_folder
+        @return int Number of removed chunks
+        """
+        with lock:
+            references = Counter()
+
+            for name in os.listdir(manifest_folder):
+                if name.endswith(self.MANIFEST_SUFFIX):
+                    with open(os.path.join(manifest_folder, name), 'r') as fin:
+                        for entry in json.load(fin)['files']:
+                            references.update(entry['chunks'])
+
+            removed = 0
+
+            if not os.path.isdir(self.path):
+                return removed
+
+            for prefix in os.listdir(self.path):
+                for checksum in os.listdir(os.path.join(self.path, prefix)):
+                    if references[checksum] == 0:
+                        os.remove(os.path.join(self.path, prefix, checksum))
+                        removed += 1
+
+            return removed
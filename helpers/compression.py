@@ -0,0 +1,91 @@
+"""Compression helper."""
+
+import os
+import shlex
+import shutil
+import subprocess
+
+EXTENSIONS = {
+    'gzip': '.gz',
+    'zstd': '.zst'
+}
+
+
+def get_command(method, level=None, threads=None):
+    """
+    Build shell command compressing stdin to stdout.
+
+    gzip uses pigz if it is installed, so both methods can use multiple threads.
+
+    @param string method 'gzip', 'zstd' or 'none'
+    @param int level (optional) Compression level
+    @param int threads (optional) Number of threads, all cores if not set
+    @return string None if no compression
+    @raises Exception
+    """
+    if not method or method == 'none':
+        return None
+
+    if method == 'zstd':
+        cmd = ['zstd', '-q', '-c', '-T{}'.format(threads or 0)]
+
+        if level and int(level) > 19:
+            cmd.append('--ultra')
+    elif method == 'gzip':
+        if shutil.which('pigz'):
+            cmd = ['pigz', '-c']
+
+            if threads:
+                cmd.append('-p {}'.format(threads))
+        else:
+            cmd = ['gzip', '-c']
+    else:
+        raise Exception('Unknown compression "{}"'.format(method))
+
+    if level:
+        cmd.append('-{}'.format(level))
+
+    return ' '.join(cmd)
+
+
+def pipe_to_file(cmd, destination, method=None, level=None, threads=None):
+    """
+    Run shell command and write its output to file, compressed if configured.
+
+    The output is written to a temporary file which is renamed when complete,
+    so a failing command never leaves a truncated file behind. Any failing
+    command in the pipeline fails the whole pipeline.
+
+    @param string cmd Shell command writing to stdout
+    @param string destination
+    @param string method (optional) 'gzip', 'zstd' or 'none'
+    @param int level (optional) Compression level
+    @param int threads (optional) Number of threads, all cores if not set
+    @raises subprocess.CalledProcessError
+    """
+    compressor = get_command(method, level, threads)
+
+    if compressor:
+        cmd += ' | ' + compressor
+
+    cmd += ' > ' + shlex.quote(destination + '.part')
+
+    try:
+        subprocess.run(['set -o pipefail; ' + cmd], shell=True, check=True, capture_output=True, executable='/bin/bash')
+    except subprocess.CalledProcessError:
+        if os.path.isfile(destination + '.part'):
+            os.remove(destination + '.part')
+
+        raise
+
+    os.replace(destination + '.part', destination)
+
+
+def get_extension(method):
+    """
+    Get file extension for compression method.
+
+    @param string method
+    @return string
+    """
+    return EXTENSIONS.get(method, '')
@@ -2,12 +2,18 @@
 
 import os
 import json
+import threading
 from pathlib import Path
 
 from . import util
 
+# Serializes writes of helpers sharing a file (e.g. aliases backed up in parallel)
+write_lock = threading.Lock()
+
 class ConfigHelper:
     """Config helper."""
+    indent = 4
+
     def __init__(self, namespace='', write_through=True, location=None):
         """
         Constructor
@@ -143,9 +149,24 @@ class ConfigHelper:
     def write(self):
         """
         Write config to file.
+
+        Namespaced helpers only write back their own namespace,
+        so that concurrent helpers don't overwrite each other's changes.
         """
-        with open(self.location, 'w+') as fout:
-            fout.write(json.dumps(self.config, indent=4))
+        with write_lock:
+            config = self.config
+
+            if self.namespace:
+                config = self.read()
+                config[self.namespace] = self.config.get(self.namespace, {})
+
+            # Write to temporary file first, so a crash can't leave a truncated file
+            tmp_location = '{}.tmp'.format(self.location)
+
+            with open(tmp_location, 'w+') as fout:
+                fout.write(json.dumps(config, indent=self.indent))
+
+            os.replace(tmp_location, self.location)
 
     def delete(self, path):
         """
@@ -160,4 +181,6 @@ class ConfigHelper:
 
         if obj is not None:
             del obj[last]
-            self.write()
+
+            if self.write_through:
+                self.write()
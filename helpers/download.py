@@ -0,0 +1,188 @@
+"""Download helper."""
+
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import urllib3
+
+
+class Downloader:
+    """Download files concurrently over one shared connection pool.
+
+    Downloads are queued with submit() and handled by a pool of workers.
+    Each file is streamed to a temporary file which is renamed when complete.
+    With resume enabled, temporary files left by an interrupted run are
+    continued using range requests. Only use this for content that never
+    changes at the same URL.
+    """
+
+    def __init__(self, logger, workers=4, chunk_size=1024 * 1024, headers=None, resume=False, metrics=None):
+        """
+        Constructor
+
+        @param Logger logger
+        @param int workers (optional) Number of concurrent downloads
+        @param int chunk_size (optional) Read buffer size in bytes
+        @param callable headers (optional) Returns request headers (e.g. for a current access token)
+        @param boolean resume (optional) Continue partial downloads
+        @param Metrics metrics (optional) Counts downloaded files and bytes, adds up the workers' time as 'transfer'
+        """
+        self.logger = logger
+        self.metrics = metrics
+        self.chunk_size = chunk_size
+        self.headers = headers or dict
+        self.resume = resume
+        self.http = urllib3.PoolManager(maxsize=workers, block=True)
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+        # Limit queued downloads, so listing can't run arbitrarily far ahead
+        self.slots = threading.BoundedSemaphore(workers * 4)
+
+    def submit(self, url, destination, callback=None):
+        """
+        Queue download.
+
+        @param string url
+        @param string destination
+        @param callable callback (optional) Called after a successful download
+        """
+        self.slots.acquire()
+        self.executor.submit(self.run, url, destination, callback)
+
+    def run(self, url, destination, callback=None):
+        """
+        Download file and log errors.
+
+        @param string url
+        @param string destination
+        @param callable callback (optional)
+        """
+        try:
+            if self.metrics:
+                with self.metrics.phase('transfer'):
+                    self.fetch(url, destination)
+            else:
+                self.fetch(url, destination)
+
+            if callback:
+                callback()
+        except Exception as err:
+            self.logger.error(err)
+        finally:
+            self.slots.release()
+
+    def fetch(self, url, destination):
+        """
+        Download file.
+
+        @param string url
+        @param string destination
+        @raises Exception
+        """
+        # Create folder if not exists
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+
+        tmp_destination = destination + '.part'
+        headers = self.headers()
+        offset = 0
+
+        if self.resume and os.path.isfile(tmp_destination):
+            offset = os.path.getsize(tmp_destination)
+            headers['Range'] = 'bytes={}-'.format(offset)
+
+        if offset:
+            self.logger.info('Resuming {} at {} bytes...'.format(destination, offset))
+        else:
+            self.logger.info('Downloading {}...'.format(destination))
+
+        res = self.http.request('GET', url, headers=headers, preload_content=False)
+
+        if self.metrics:
+            self.metrics.add('api_calls')
+
+        try:
+            if res.status not in [200, 206]:
+                raise Exception('Download failed ({}) -> {}'.format(res.status, str(res.data)))
+
+            # Server ignored the range, start over
+            mode = 'ab' if res.status == 206 else 'wb'
+
+            size = 0
+
+            with open(tmp_destination, mode) as out:
+                for chunk in res.stream(self.chunk_size):
+                    out.write(chunk)
+                    size += len(chunk)
+
+            os.replace(tmp_destination, destination)
+
+            if self.metrics:
+                self.metrics.add('bytes', size)
+                self.metrics.add('files')
+        except Exception:
+            # Without resume nothing would ever pick up the partial file
+            if not self.resume and os.path.isfile(tmp_destination):
+                os.remove(tmp_destination)
+
+            raise
+        finally:
+            res.release_conn()
+
+    def wait(self):
+        """
+        Wait for all queued downloads and stop workers.
+        """
+        self.executor.shutdown(wait=True)
+
+
+def save(res, destination, logger, chunk_size=1024 * 1024, progress_interval=10, metrics=None):
+    """
+    Stream response of a requests session to file.
+
+    The file is written to a temporary file which is renamed when complete.
+    Progress is logged every progress_interval seconds and throughput at the end.
+
+    @param requests.Response res Response of a request with stream=True
+    @param string destination
+    @param Logger logger
+    @param int chunk_size (optional) Read buffer size in bytes
+    @param int progress_interval (optional) Seconds between progress messages
+    @param Metrics metrics (optional) Counts downloaded files and bytes
+    @return int Number of bytes written
+    """
+    tmp_destination = destination + '.part'
+    started = time.monotonic()
+    last_progress = started
+    size = 0
+
+    try:
+        with open(tmp_destination, 'wb') as out:
+            for chunk in res.iter_content(chunk_size):
+                out.write(chunk)
+                size += len(chunk)
+
+                if time.monotonic() - last_progress >= progress_interval:
+                    last_progress = time.monotonic()
+                    logger.info('{}: {:.1f} MiB downloaded...'.format(os.path.basename(destination), size / 1024 / 1024))
+    except Exception:
+        # Don't leave partial files in the backup
+        if os.path.isfile(tmp_destination):
+            os.remove(tmp_destination)
+
+        raise
+    finally:
+        res.close()
+
+    os.replace(tmp_destination, destination)
+
+    if metrics:
+        metrics.add('bytes', size)
+        metrics.add('files')
+
+    duration = max(time.monotonic() - started, 0.001)
+    logger.info('{}: {:.1f} MiB in {:.1f}s ({:.1f} MiB/s)'.format(
+        os.path.basename(destination), size / 1024 / 1024, duration, size / 1024 / 1024 / duration))
+
+    return size
@@ -0,0 +1,44 @@
+"""Git helper."""
+
+import os
+import time
+import subprocess
+
+
+def mirror(url, path):
+    """
+    Create or update bare mirror of a repository.
+
+    Mirrors contain all branches and tags and are updated
+    with fetch --prune, so no working tree is ever touched.
+
+    @param string url
+    @param string path
+    @raises subprocess.CalledProcessError
+    """
+    if os.path.exists(path):
+        subprocess.run(['git', '-C', path, 'fetch', '--prune', 'origin'], check=True, capture_output=True)
+    else:
+        subprocess.run(['git', 'clone', '--mirror', url, path], check=True, capture_output=True)
+
+
+def gc_if_due(path, cache, key, interval):
+    """
+    Run git gc on repository if the last run is more than interval days ago.
+
+    @param string path
+    @param SQLiteCache cache
+    @param string key Cache key of the repository
+    @param int interval Days between runs, never run if not set
+    @raises subprocess.CalledProcessError
+    """
+    if not interval:
+        return
+
+    last_gc = cache.get(key, {}).get('gc', 0)
+
+    if time.time() - last_gc < interval * 86400:
+        return
+
+    subprocess.run(['git', '-C', path, 'gc', '--quiet'], check=True, capture_output=True)
+    cache.set(key, gc=time.time())
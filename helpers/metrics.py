@@ -0,0 +1,81 @@
+"""Metrics of a backup run."""
+
+import time
+import threading
+from contextlib import contextmanager
+
+
+class Metrics:
+    """Thread-safe counters and phase timings of a backup run.
+
+    Counters are 'bytes', 'files', 'api_calls' and 'retries', phases are
+    named freely (e.g. 'listing', 'transfer', 'cleanup', 'rotation'). Phases
+    may overlap, e.g. when files are downloaded while still listing. Phases
+    run by several workers add up the time of all workers.
+    """
+    COUNTERS = ['bytes', 'files', 'api_calls', 'retries']
+
+    def __init__(self):
+        """Constructor."""
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.finished = None
+        self.counters = dict.fromkeys(self.COUNTERS, 0)
+        self.phases = {}
+
+    def add(self, name, value=1):
+        """
+        Increase counter.
+
+        @param string name
+        @param int value (optional)
+        """
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Measure time spent in a phase, adding up repeated phases.
+
+        @param string name
+        """
+        started = time.monotonic()
+
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.phases[name] = self.phases.get(name, 0) + time.monotonic() - started
+
+    def merge(self, other):
+        """
+        Add counters and phases of another run (e.g. a part of this one).
+
+        @param dict other As returned by to_dict()
+        """
+        with self.lock:
+            for name in self.COUNTERS:
+                self.counters[name] = self.counters.get(name, 0) + other.get(name, 0)
+
+            for name, duration in other.get('phases', {}).items():
+                self.phases[name] = self.phases.get(name, 0) + duration
+
+    def stop(self):
+        """Stop measuring wall time."""
+        self.finished = time.time()
+
+    def to_dict(self):
+        """
+        Get metrics as dict.
+
+        @return dict
+        """
+        with self.lock:
+            return {
+                'started': self.started,
+                'finished': self.finished,
+                'duration': round((self.finished or time.time()) - self.started, 3),
+                **self.counters,
+                'phases': {name: round(duration, 3) for name, duration in self.phases.items()}
+            }
@@ -0,0 +1,108 @@
+"""Prometheus textfile exporter."""
+
+import os
+import time
+
+from helpers.cache import Cache
+
+# Name, help and the key of the value in a result
+METRICS = [
+    ('backup_last_run_timestamp_seconds', 'Time the last backup finished.', 'finished'),
+    ('backup_last_success_timestamp_seconds', 'Time the last backup without errors finished.', 'last_success'),
+    ('backup_duration_seconds', 'Wall time of the last backup.', 'duration'),
+    ('backup_bytes', 'Bytes transferred by the last backup.', 'bytes'),
+    ('backup_items', 'Files or items processed by the last backup.', 'files'),
+    ('backup_api_calls', 'API calls made by the last backup.', 'api_calls'),
+    ('backup_retries', 'Requests retried by the last backup.', 'retries'),
+    ('backup_errors', 'Errors logged by the last backup.', 'errors'),
+    ('backup_warnings', 'Warnings logged by the last backup.', 'warnings')
+]
+
+
+def escape(value):
+    """
+    Escape label value.
+
+    @param string value
+    @return string
+    """
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def update(results):
+    """
+    Remember the latest results of all aliases.
+
+    Aliases not backed up in this run keep their previous values,
+    so their last success doesn't disappear from the metrics.
+
+    @param list results
+    @return dict Latest result by alias
+    """
+    cache = Cache('prometheus')
+
+    for res in results:
+        metrics = res.get('metrics', {})
+        previous = cache.get(res['alias'], {})
+
+        cache.set(res['alias'], {
+            'type': res.get('type', ''),
+            'finished': metrics.get('finished') or time.time(),
+            'last_success': (metrics.get('finished') or time.time()) if not res.get('errors') else previous.get('last_success'),
+            'duration': metrics.get('duration', 0),
+            'bytes': metrics.get('bytes', 0),
+            'files': metrics.get('files', 0),
+            'api_calls': metrics.get('api_calls', 0),
+            'retries': metrics.get('retries', 0),
+            'errors': res.get('errors', 0),
+            'warnings': res.get('warnings', 0),
+            'phases': metrics.get('phases', {})
+        })
+
+    cache.flush()
+
+    return cache.get()
+
+
+def format_metrics(entries):
+    """
+    Format results in the Prometheus text format.
+
+    @param dict entries Latest result by alias
+    @return string
+    """
+    lines = []
+
+    for name, description, key in METRICS:
+        lines.append('# HELP {} {}'.format(name, description))
+        lines.append('# TYPE {} gauge'.format(name))
+
+        for alias, entry in sorted(entries.items()):
+            if entry.get(key) is not None:
+                lines.append('{}{{alias="{}",type="{}"}} {}'.format(name, escape(alias), escape(entry['type']), entry[key]))
+
+    lines.append('# HELP backup_phase_duration_seconds Time spent in each phase of the last backup.')
+    lines.append('# TYPE backup_phase_duration_seconds gauge')
+
+    for alias, entry in sorted(entries.items()):
+        for phase, duration in sorted(entry.get('phases', {}).items()):
+            lines.append('backup_phase_duration_seconds{{alias="{}",type="{}",phase="{}"}} {}'.format(escape(alias), escape(entry['type']), escape(phase), duration))
+
+    return '\n'.join(lines) + '\n'
+
+
+def write_textfile(path, results):
+    """
+    Write metrics for node_exporter's textfile collector.
+
+    The file is replaced atomically, so the collector never reads a partial file.
+
+    @param string path
+    @param list results
+    """
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+
+    with open(tmp_path, 'w') as fout:
+        fout.write(format_metrics(update(results)))
+
+    os.replace(tmp_path, path)
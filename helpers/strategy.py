@@ -2,6 +2,8 @@
 
 import os
 import json
+import threading
+import contextlib
 import traceback
 import logging
 import logging.config
@@ -10,6 +12,13 @@ import yaml
 from helpers import util
 from helpers.log_counter_handler import LogCounterHandler
 from helpers.config import ConfigHelper
+from helpers.chunkstore import ChunkStore
+from helpers.metrics import Metrics
+
+# Logging is configured once per process, so that strategies running in
+# parallel don't disable each other's loggers by re-applying the config
+logging_lock = threading.Lock()
+logging_configured = False
 
 
 class Strategy:
@@ -19,6 +28,8 @@ class Strategy:
     logger = None
     config = None
     alias = None
+    cache = None
+    metrics = None
     multipart = False
     backup_path = ''
     common_fields = ['backup_path', 'type']
@@ -33,12 +44,18 @@ class Strategy:
 
         @param string alias (optional)
         """
+        global logging_configured
+
         alias = alias or self.__class__.__name__
 
-        # Load logger config
-        with open(os.path.join('config', 'logger.yaml'), 'r') as f:
-            config = yaml.safe_load(f.read())
-            logging.config.dictConfig(config)
+        with logging_lock:
+            if not logging_configured:
+                # Load logger config
+                with open(os.path.join('config', 'logger.yaml'), 'r') as f:
+                    config = yaml.safe_load(f.read())
+                    logging.config.dictConfig(config)
+
+                logging_configured = True
 
         logger = logging.getLogger(alias)
         logger.addHandler(self.msg_counter_handler)
@@ -64,8 +81,8 @@ class Strategy:
 
     def get_warning_count(self):
         """Get warnings count from logger handler."""
-        if 'WARN' in self.msg_counter_handler.level_to_count:
-            return self.msg_counter_handler.level_to_count['WARN']
+        if 'WARNING' in self.msg_counter_handler.level_to_count:
+            return self.msg_counter_handler.level_to_count['WARNING']
         else:
             return 0
 
@@ -154,6 +171,8 @@ class Strategy:
         @param boolean multipart (optional)
         @return dict
         """
+        self.metrics = Metrics()
+
         try:
             # self.logger.set_source(alias)
             self.logger = self.init_logger(alias)
@@ -197,10 +216,19 @@ class Strategy:
         except Exception as err:
             self.logger.error(err)
             traceback.print_exc()
+        finally:
+            # Persist cached state, even if the backup failed
+            if self.cache:
+                self.cache.flush()
+
+            self.metrics.stop()
 
         return {
+            'alias': alias,
+            'type': self.TYPE,
             'errors': self.get_error_count(),
-            'warnings': self.get_warning_count()
+            'warnings': self.get_warning_count(),
+            'metrics': self.metrics.to_dict()
         }
 
     def start_backup(self):
@@ -212,14 +240,59 @@ class Strategy:
         if self.multipart:
             return
 
-        if self.config.get('versions'):
-            # Remove old versions
-            util.cleanup_versions(self.config.get(
-                'backup_path'), self.config.get('versions'), self.alias)
+        with self.phase('rotation'):
+            if self.config.get('dedup'):
+                # Replace versions by manifests of deduplicated chunks
+                self.deduplicate()
+
+            if self.config.get('versions'):
+                # Remove old versions
+                util.cleanup_versions(self.config.get(
+                    'backup_path'), self.config.get('versions'), self.alias)
+
+                if self.config.get('dedup'):
+                    # Remove chunks no version refers to anymore
+                    removed = self.get_chunk_store().collect_garbage(self.config.get('backup_path'))
+                    self.logger.info('Removed {} unused chunks'.format(removed))
 
         # Done
         self.logger.info('Done')
 
+    def phase(self, name):
+        """
+        Measure time spent in a phase of the backup.
+
+        @param string name e.g. 'listing', 'transfer', 'cleanup'
+        @return contextmanager
+        """
+        # Nothing to measure outside of a backup (e.g. when adding an alias)
+        if not self.metrics:
+            return contextlib.nullcontext()
+
+        return self.metrics.phase(name)
+
+    def get_chunk_store(self):
+        """
+        Get chunk store shared by all aliases in the backup path.
+
+        @return ChunkStore
+        """
+        return ChunkStore(os.path.join(self.config.get('backup_path'), ChunkStore.FOLDER))
+
+    def deduplicate(self):
+        """Move all versions not yet deduplicated into the chunk store."""
+        store = self.get_chunk_store()
+
+        for version in util.get_versions(self.config.get('backup_path'), self.alias):
+            if version.endswith(ChunkStore.MANIFEST_SUFFIX) or version.endswith('.tmp'):
+                continue
+
+            stats = store.ingest(version, version + ChunkStore.MANIFEST_SUFFIX)
+            util.remove(version)
+
+            self.logger.info('Deduplicated {}: {} files, {} of {} bytes new'.format(
+                os.path.basename(version), stats['files'], stats['new_bytes'], stats['bytes']))
+
     def build_default_string(self, param):
         """Build default value string to be displayed in add prompt.
 
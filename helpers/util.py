@@ -4,6 +4,7 @@ import os
 import datetime
 import shutil
 import hashlib
+import tempfile
 from pathlib import Path
 
 startup_time = datetime.datetime.now().strftime('%Y-%m-%d_%H%M%S')
@@ -14,9 +15,9 @@ def remove(path):
 
     @param string path
     """
-    if os.path.isfile(path):
+    if os.path.islink(path) or os.path.isfile(path):
         os.remove(path)
-    else:
+    elif os.path.isdir(path):
         shutil.rmtree(path)
 
 def create_folder(path):
@@ -68,6 +69,25 @@ def md5_file(path):
 
     return checksum.hexdigest()
 
+def get_size(path):
+    """
+    Get size of file or folder (recursively).
+
+    @param string path
+    @return int Size in bytes
+    """
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+
+    size = 0
+
+    for root, _, files in os.walk(path):
+        for name in files:
+            if not os.path.islink(os.path.join(root, name)):
+                size += os.path.getsize(os.path.join(root, name))
+
+    return size
+
 def get_project_path():
     """
     Get absolute path of project folder.
@@ -76,9 +96,13 @@ def get_project_path():
     """
     return os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
 
-def cleanup_versions(backup_path, versions, prefix=''):
+def get_versions(backup_path, prefix=''):
     """
-    Remove all but the latest x files in a folder.
+    Get all versions (files or folders) in a folder, latest first.
+
+    @param string backup_path
+    @param string prefix
+    @return list
     """
     # Get directory content
     items = os.listdir(backup_path)
@@ -89,10 +113,20 @@ def cleanup_versions(backup_path, versions, prefix=''):
     # Filter for prefix
     items = list(filter(lambda item: os.path.basename(item).startswith(prefix + '_'), items))
 
-    # Filter by modification date descending
-    items.sort(key=os.path.getmtime, reverse=True)
+    # Sort by modification date descending (without following symlinks)
+    items.sort(key=lambda item: os.lstat(item).st_mtime, reverse=True)
+
+    return items
+
+def cleanup_versions(backup_path, versions, prefix=''):
+    """
+    Remove all but the latest x files or folders in a folder.
 
-    for item in items[versions:]:
+    @param string backup_path
+    @param int versions
+    @param string prefix
+    """
+    for item in get_versions(backup_path, prefix)[versions:]:
         remove(item)
 
 def get_tmp_path():
@@ -110,7 +144,4 @@ def create_tmp_folder():
 
     @return string
     """
-    tmp_path = os.path.join(get_tmp_path(), md5(str(datetime.datetime.now().timestamp())))
-    Path(tmp_path).mkdir(parents=True, exist_ok=True)
-
-    return tmp_path
+    return tempfile.mkdtemp(dir=get_tmp_path())
@@ -2,9 +2,12 @@
 
 import os
 import sys
+import json
 import shutil
 import logging
 import logging.config
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from urllib.parse import urlparse
 import yaml
 
 from strategies.github import Github
@@ -20,8 +23,10 @@ from strategies.postgresql import PostgreSQL
 
 from helpers import util
 from helpers import mail
+from helpers import prometheus
 from helpers.argumentparser import ArgumentParser
 from helpers.config import ConfigHelper
+from helpers.chunkstore import ChunkStore
 
 strategies = [
     Github,
@@ -52,13 +57,81 @@ def type_to_strategy(strategy_type):
     return None
 
 
+def get_host(entry, strategy):
+    """Determine the host or API an alias talks to.
+
+    @param dict entry
+    @param Strategy strategy
+    @return string
+    """
+    if entry.get('ssh_host'):
+        return entry['ssh_host']
+
+    if entry.get('db_host'):
+        return entry['db_host']
+
+    if getattr(strategy, 'API_URL', None):
+        return urlparse(strategy.API_URL).netloc
+
+    return strategy.TYPE
+
+
+def run_backups(jobs):
+    """Run backups using a bounded pool of workers.
+
+    At most 'general.workers' aliases are backed up at the same time
+    and at most 'general.max_per_host' of them may talk to the same host.
+
+    @param list jobs List of (alias, strategy, host) tuples
+    @return list
+    """
+    workers = max(1, int(config.get('general.workers', 1)))
+    max_per_host = max(1, int(config.get('general.max_per_host', workers)))
+
+    pending = list(jobs)
+    running = {}
+    per_host = {}
+    results = []
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while pending or running:
+            # Start as many jobs as workers and host limits allow
+            for job in list(pending):
+                if len(running) >= workers:
+                    break
+
+                alias, strategy, host = job
+
+                if per_host.get(host, 0) >= max_per_host:
+                    continue
+
+                pending.remove(job)
+                per_host[host] = per_host.get(host, 0) + 1
+                running[executor.submit(strategy().backup, alias)] = job
+
+            # Wait for at least one job to finish
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                alias, strategy, host = running.pop(future)
+                per_host[host] -= 1
+
+                try:
+                    results.append(future.result())
+                except Exception as err:
+                    logger.error('Backup of "{}" failed: {}'.format(alias, err))
+                    results.append({'alias': alias, 'type': strategy.TYPE, 'errors': 1, 'warnings': 0, 'metrics': {}})
+
+    return results
+
+
 def parse_args():
     """Parse command line arguments.
 
     @return dict
     """
     parser = ArgumentParser()
-    parser.add_argument('action', type=str, help='Action to perform. Can be one of: add|backup. backup may be followed by aliases to be backed up exclusively.')
+    parser.add_argument('action', type=str, help='Action to perform. Can be one of: add|backup|restore. backup may be followed by aliases to be backed up exclusively. restore expects a manifest and a destination folder.')
     arguments, _ = parser.parse_known_args()
 
     return arguments
@@ -80,11 +153,64 @@ def configure_mail():
     config.set('general.mail.failure_only', failure_only)
 
 
-def format_mail_body(warnings, errors):
+def write_report(results):
+    """Write metrics of all backups to a JSON report next to the logs.
+
+    @param list results
+    @return string Path of the report
+    """
+    path = os.path.join('log', 'run_{}.json'.format(util.startup_time))
+
+    with open(path, 'w') as fout:
+        fout.write(json.dumps({
+            'started': util.startup_time,
+            'aliases': results
+        }, indent=4))
+
+    return path
+
+
+def format_summary(results):
+    """Format metrics of all backups as HTML table.
+
+    @param list results
+
+    @return string
+    """
+    columns = ['Alias', 'Type', 'Duration', 'MiB', 'Files', 'API calls', 'Retries', 'Phases', 'Warnings', 'Errors']
+    rows = []
+
+    for res in results:
+        metrics = res.get('metrics', {})
+        phases = ', '.join('{} {:.1f}s'.format(name, duration) for name, duration in metrics.get('phases', {}).items())
+
+        rows.append([
+            res.get('alias', ''),
+            res.get('type', ''),
+            '{:.1f}s'.format(metrics.get('duration', 0)),
+            '{:.1f}'.format(metrics.get('bytes', 0) / 1024 / 1024),
+            metrics.get('files', 0),
+            metrics.get('api_calls', 0),
+            metrics.get('retries', 0),
+            phases,
+            res.get('warnings', 0),
+            res.get('errors', 0)
+        ])
+
+    html = '<table>\n<tr>' + ''.join('<th>{}</th>'.format(column) for column in columns) + '</tr>\n'
+
+    for row in rows:
+        html += '<tr>' + ''.join('<td>{}</td>'.format(value) for value in row) + '</tr>\n'
+
+    return html + '</table>'
+
+
+def format_mail_body(warnings, errors, results=[]):
     """Format mail body.
 
     @param int warnings
     @param int errors
+    @param list results (optional) Results of all backups
 
     @return string
     """
@@ -92,10 +218,23 @@ def format_mail_body(warnings, errors):
         html = fin.read()
         html = html.replace('{{ warnings }}', str(warnings))
         html = html.replace('{{ errors }}', str(errors))
+        html = html.replace('{{ summary }}', format_summary(results))
 
         return html
 
 
+def restore(manifest, destination):
+    """Restore deduplicated version from the chunk store next to its manifest.
+
+    @param string manifest
+    @param string destination
+    """
+    store = ChunkStore(os.path.join(os.path.dirname(os.path.abspath(manifest)), ChunkStore.FOLDER))
+    store.restore(manifest, destination)
+
+    logger.info('Restored {} to {}'.format(manifest, destination))
+
+
 def show_add_menu():
     """Display menu for adding accounts."""
     print('--- Select type: ---')
@@ -139,9 +278,19 @@ if __name__ == '__main__':
     # Initialize Logger
     logger = init_logger()
 
+    # Restore doesn't need any account
+    if args.action == 'restore':
+        if len(sys.argv) != 4:
+            logger.error('Usage: main.py restore <manifest> <destination>')
+            sys.exit(2)
+
+        restore(sys.argv[2], sys.argv[3])
+        sys.exit(0)
+
     # Count warnings and errors
     warnings = 0
     errors = 0
+    results = []
 
     # Configure mail if necessary
     if not config.exists('general.mail.user'):
@@ -154,6 +303,8 @@ if __name__ == '__main__':
         aliases = sys.argv[2:] if len(
             sys.argv) > 2 else list(config.config.keys())
 
+        jobs = []
+
         for alias in aliases:
             entry = config.get(alias)
 
@@ -168,12 +319,27 @@ if __name__ == '__main__':
                     logger.error('Type "{}" not found'.format(entry['type']))
                     continue
 
-                module = strategy()
+                jobs.append((alias, strategy, get_host(entry, strategy)))
+
+        results = run_backups(jobs)
+
+        for res in results:
+            warnings += int(res['warnings'])
+            errors += int(res['errors'])
 
-                res = module.backup(alias)
+        # Keep metrics of this run, without keeping the mail from being sent
+        try:
+            logger.info('Run report written to {}'.format(write_report(results)))
+        except OSError as err:
+            logger.error('Error writing run report: {}'.format(err))
+            errors += 1
 
-                warnings += int(res['warnings'])
-                errors += int(res['errors'])
+        if config.get('general.prometheus_textfile'):
+            try:
+                prometheus.write_textfile(config.get('general.prometheus_textfile'), results)
+            except OSError as err:
+                logger.error('Error writing Prometheus textfile: {}'.format(err))
+                errors += 1
     else:
         sys.exit(2)
 
@@ -185,6 +351,6 @@ if __name__ == '__main__':
 
     # Mail log
     if config.get('general.mail.user') and config.get('general.mail.pass') and (warnings > 0 or errors > 0 or not config.get('general.mail.failure_only')):
-        mail_body = format_mail_body(warnings, errors)
+        mail_body = format_mail_body(warnings, errors, results)
         mail.send_gmail(config.get('general.mail.user'), config.get('general.mail.pass'),
                         [config.get('general.mail.user')], 'Backup My Accounts', mail_body)
@@ -2,11 +2,36 @@
 
 import os
 import re
+import shutil
+import hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 import dropbox
 
-from helpers.cache import Cache
+from helpers.cache import SQLiteCache
 from helpers.strategy import Strategy
 
+BLOCK_SIZE = 4 * 1024 * 1024
+
+
+def content_hash(path):
+    """
+    Calculate Dropbox content hash of a local file.
+
+    That is the SHA-256 of the concatenated SHA-256 of every 4 MiB block.
+
+    @param string path
+    @return string
+    """
+    checksum = hashlib.sha256()
+
+    with open(path, 'rb') as fin:
+        for block in iter(lambda: fin.read(BLOCK_SIZE), b''):
+            checksum.update(hashlib.sha256(block).digest())
+
+    return checksum.hexdigest()
+
+
 class Dropbox(Strategy):
     """Backup strategy for Dropbox."""
     NAME = 'Dropbox'
@@ -18,39 +43,144 @@ class Dropbox(Strategy):
         """
         Start backup.
         """
-        self.cache = Cache(self.alias)
+        self.cache = SQLiteCache(self.alias, legacy_format='hashes')
 
         self.dbx = dropbox.Dropbox(self.config.get('token'))
 
-        # Get files recursively
-        self.get_children()
+        # Rebuild lost cache from disk instead of downloading everything again
+        if not self.cache.count():
+            with self.phase('rebuild'):
+                self.rebuild_cache()
+
+        # Every version is a new folder, which only a full listing fills completely
+        versioned = self.backup_path != self.config.get('backup_path')
+
+        # Continue from the last backup's cursor if there is one
+        cursor = self.cache.get_meta('cursor') if not versioned else None
+        errors = self.get_error_count()
+
+        # Listing and downloading are interleaved
+        with self.phase('transfer'):
+            if cursor:
+                try:
+                    cursor = self.get_changes(cursor)
+                except dropbox.exceptions.ApiError as err:
+                    if not isinstance(err.error, dropbox.files.ListFolderContinueError) or not err.error.is_reset():
+                        raise
+
+                    self.logger.warning('Cursor has been reset, starting over')
+                    cursor = None
+
+            if not cursor:
+                # Get files recursively
+                cursor = self.get_children()
+
+        if versioned:
+            # Don't let a later unversioned backup continue from a stale cursor
+            self.cache.set_meta('cursor', None)
+        elif self.get_error_count() == errors:
+            # Remember cursor, unless changes may have been missed
+            self.cache.set_meta('cursor', cursor)
+
+    def rebuild_cache(self):
+        """
+        Hash all files in backup path in parallel and add them to cache.
+        """
+        files = []
+
+        for root, _dirs, filenames in os.walk(self.backup_path):
+            files.extend(os.path.join(root, filename) for filename in filenames if not filename.endswith('.part'))
+
+        if not files:
+            return
+
+        self.logger.info('Rebuilding cache from {} local file(s)...'.format(len(files)))
+
+        # Forking while other aliases' threads hold locks could deadlock the children
+        context = multiprocessing.get_context('spawn')
+
+        with ProcessPoolExecutor(max_workers=self.config.get('hash_workers'), mp_context=context) as executor:
+            hashes = executor.map(content_hash, files, chunksize=16)
+
+            self.cache.set_many([
+                ('/' + os.path.relpath(path, self.backup_path), {'hash': checksum, 'path': path})
+                for path, checksum in zip(files, hashes)
+            ])
 
     def get_children(self, path=''):
         """
-        Get items in directory.
+        Get all items below directory.
 
         @param string path (optional)
+        @return string Cursor for fetching later changes
         """
-        res = self.dbx.files_list_folder(path=path)
+        res = self.dbx.files_list_folder(path=path, recursive=True)
+        self.metrics.add('api_calls')
 
-        for entry in res.entries:
-            if self.check_if_excluded(entry.path_display):
-                continue
-            elif isinstance(entry, dropbox.files.FolderMetadata):
-                self.get_children(entry.path_display)
-            else:
-                destination = os.path.join(self.backup_path, entry.path_display.strip('/'))
-                self.logger.info(entry.path_display)
+        return self.process_entries(res)
 
-                content_hash = self.cache.get(entry.path_display)
+    def get_changes(self, cursor):
+        """
+        Get all items that changed since cursor.
+
+        @param string cursor
+        @return string Cursor for fetching later changes
+        """
+        res = self.dbx.files_list_folder_continue(cursor)
+        self.metrics.add('api_calls')
+
+        return self.process_entries(res)
+
+    def process_entries(self, res):
+        """
+        Process all pages of a listing.
 
-                if not os.path.isfile(destination) or content_hash != entry.content_hash:
-                    self.cache.set(entry.path_display, entry.content_hash)
+        @param ListFolderResult res
+        @return string Cursor for fetching later changes
+        """
+        while True:
+            for entry in res.entries:
+                self.process_entry(entry)
+
+            if not res.has_more:
+                return res.cursor
+
+            res = self.dbx.files_list_folder_continue(res.cursor)
+            self.metrics.add('api_calls')
+
+    def process_entry(self, entry):
+        """
+        Download, update or delete a single item.
+
+        @param Metadata entry
+        """
+        if self.check_if_excluded(entry.path_display):
+            return
+
+        destination = os.path.join(self.backup_path, entry.path_display.strip('/'))
+
+        if isinstance(entry, dropbox.files.DeletedMetadata):
+            self.delete(destination)
+        elif isinstance(entry, dropbox.files.FileMetadata):
+            self.logger.info(entry.path_display)
+
+            cached = self.cache.get(entry.path_display, {})
+
+            # Not in cache, but maybe it has been downloaded before
+            if not cached and os.path.isfile(destination) and content_hash(destination) == entry.content_hash:
+                self.cache.set(entry.path_display, hash=entry.content_hash, path=destination)
+                return
+
+            if not os.path.isfile(destination) or cached.get('hash') != entry.content_hash:
+                try:
                     self.download(entry.path_display, destination)
+                    self.cache.set(entry.path_display, hash=entry.content_hash, path=destination)
+                except Exception as err:
+                    self.logger.error('Error downloading {}: {}'.format(entry.path_display, err))
 
     def download(self, dropbox_path, destination):
         """
-        Download file.
+        Download file in chunks.
 
         @param string dropbox_path
         @param string destination
@@ -60,9 +190,44 @@ class Dropbox(Strategy):
         if not os.path.exists(parent):
             os.makedirs(parent)
 
-        with open(destination, 'wb+') as fout:
-            _metadata, res = self.dbx.files_download(path=dropbox_path)
-            fout.write(res.content)
+        tmp_destination = destination + '.part'
+        _metadata, res = self.dbx.files_download(path=dropbox_path)
+        self.metrics.add('api_calls')
+        size = 0
+
+        try:
+            with open(tmp_destination, 'wb') as fout:
+                for chunk in res.iter_content(self.config.get('download_chunk_size', 1024 * 1024)):
+                    fout.write(chunk)
+                    size += len(chunk)
+        except Exception:
+            # Don't leave partial files in the backup
+            if os.path.isfile(tmp_destination):
+                os.remove(tmp_destination)
+
+            raise
+        finally:
+            res.close()
+
+        os.replace(tmp_destination, destination)
+
+        self.metrics.add('bytes', size)
+        self.metrics.add('files')
+
+    def delete(self, destination):
+        """
+        Delete file or folder that has been removed from Dropbox.
+
+        @param string destination
+        """
+        if os.path.isdir(destination):
+            self.logger.info('Deleting {}'.format(destination))
+            shutil.rmtree(destination)
+        elif os.path.isfile(destination):
+            self.logger.info('Deleting {}'.format(destination))
+            os.remove(destination)
+
+        self.cache.delete_path(destination)
 
     def check_if_excluded(self, path):
         """
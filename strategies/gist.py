@@ -3,12 +3,14 @@
 import os
 import re
 import subprocess
-import urllib.request
 import hashlib
-import shutil
 import requests
 
+from helpers import git
+from helpers import archive
 from helpers import util
+from helpers import download
+from helpers.cache import SQLiteCache
 from helpers.strategy import Strategy
 
 class Gist(Strategy):
@@ -16,19 +18,28 @@ class Gist(Strategy):
     NAME = 'Gist'
     TYPE = 'gist'
     API_URL = 'https://api.github.com'
+    session = None
 
     def start_backup(self):
         """
         Start backup.
         """
+        # Housekeeping state of mirrors
+        self.cache = SQLiteCache(self.alias)
+
+        self.session = requests.Session()
+        self.session.auth = (self.config.get('username'), self.config.get('token'))
+
         # Get all gists
-        gists = self.get_gists()
+        with self.phase('listing'):
+            gists = self.get_gists()
 
-        for gist in gists:
-            if self.config.get('archive'):
-                self.archive(gist, True)
-            else:
-                self.sync(gist)
+        with self.phase('transfer'):
+            for gist in gists:
+                if self.config.get('archive'):
+                    self.archive(gist, True)
+                else:
+                    self.sync(gist)
 
     def get_gists(self, page_url=''):
         """
@@ -39,7 +50,8 @@ class Gist(Strategy):
         """
         gists = []
         url = page_url if page_url else '{api_url}/users/{username}/gists'.format(api_url=self.API_URL, username=self.config.get('username'))
-        res = requests.get(url, auth=(self.config.get('username'), self.config.get('token')))
+        res = self.session.get(url)
+        self.metrics.add('api_calls')
 
         if res.status_code == 200:
             for gist in res.json():
@@ -81,12 +93,12 @@ class Gist(Strategy):
         @param string gist_name
         """
         for filename in os.listdir(path):
-            if re.search('^' + gist_name + r'-.*\.zip', filename):
+            if re.search('^' + re.escape(gist_name) + r'-.*\.(zip|tar|tar\.gz|tar\.zst)$', filename):
                 os.remove(os.path.join(self.backup_path, filename))
 
     def archive(self, gist, check_if_exists=False):
         """
-        Download gist as zip file.
+        Download gist as archive.
 
         @param dict gist
         @param string check_if_exists (optional)
@@ -105,7 +117,9 @@ class Gist(Strategy):
         destination = os.path.join(self.backup_path, gist['id'] + '-' + first_filename + '-' + version)
 
         # Check if file exists
-        if check_if_exists and os.path.isfile(destination + '.zip'):
+        fmt = self.config.get('archive_format', 'zip')
+
+        if check_if_exists and os.path.isfile(destination + archive.get_extension(fmt)):
             self.logger.info('{} is up-to-date'.format(gist['id']))
             return
 
@@ -117,7 +131,7 @@ class Gist(Strategy):
             self.download(gist['files'][file]['raw_url'], tmp_path, gist['files'][file]['filename'])
 
         # Create archive from tmp
-        shutil.make_archive(destination, 'zip', tmp_path)
+        archive.make_archive(destination, tmp_path, fmt, self.config.get('compression_level'), self.config.get('compression_threads'))
 
     def sync(self, gist):
         """
@@ -129,12 +143,19 @@ class Gist(Strategy):
         version = self.get_current_version(gist)
 
         try:
-            if os.path.exists(os.path.join(self.backup_path, gist['id'])):
+            if self.config.get('mirror'):
+                path = os.path.join(self.backup_path, gist['id'] + '.git')
+                self.logger.info('Mirroring {} ({})...'.format(gist['id'], version))
+                git.mirror(gist['git_pull_url'], path)
+                git.gc_if_due(path, self.cache, gist['id'], self.config.get('gc_interval'))
+            elif os.path.exists(os.path.join(self.backup_path, gist['id'])):
                 self.logger.info('Pulling {} ({})...'.format(gist['id'], version))
                 subprocess.run(['git', '-C', os.path.join(self.backup_path, gist['id']), 'pull', '--rebase', gist['git_pull_url']], check=True, capture_output=True)
             else:
                 self.logger.info('Cloning {} ({})...'.format(gist['id'], version))
                 subprocess.run(['git', '-C', self.backup_path, 'clone', gist['git_pull_url']], check=True, capture_output=True)
+
+            self.metrics.add('files')
         except subprocess.CalledProcessError as err:
             self.logger.error('Error synchronizing gist: {} STDOUT: {})'.format(err.stderr.decode('utf-8'), err.stdout.decode('utf-8')))
 
@@ -146,14 +167,12 @@ class Gist(Strategy):
         @param string path
         @param string filename
         """
-        # Prepare urllib
-        passman = urllib.request.HTTPPasswordMgrWithDefaultRealm()
-        passman.add_password(None, url, self.config.get('username'), self.config.get('token'))
-        authhandler = urllib.request.HTTPBasicAuthHandler(passman)
-        opener = urllib.request.build_opener(authhandler)
-        urllib.request.install_opener(opener)
-
-        # Actually download the file
-        with urllib.request.urlopen(url) as response, open(os.path.join(path, filename), 'wb') as out_file:
-            data = response.read()
-            out_file.write(data)
+        res = self.session.get(url, stream=True)
+        self.metrics.add('api_calls')
+
+        if res.status_code != 200:
+            res.close()
+            raise Exception('Error downloading {} ({})'.format(url, res.status_code))
+
+        download.save(res, os.path.join(path, filename), self.logger,
+                      self.config.get('download_chunk_size', 1024 * 1024), metrics=self.metrics)
@@ -3,9 +3,12 @@
 import os
 import re
 import subprocess
-import urllib.request
+from concurrent.futures import ThreadPoolExecutor
 import requests
 
+from helpers import git
+from helpers import download
+from helpers.cache import SQLiteCache
 from helpers.strategy import Strategy
 
 class Github(Strategy):
@@ -13,19 +16,49 @@ class Github(Strategy):
     NAME = 'GitHub'
     TYPE = 'github'
     API_URL = 'https://api.github.com'
+    GRAPHQL_QUERY = '''
+        query($login: String!, $after: String) {
+            user(login: $login) {
+                repositories(first: 100, after: $after, ownerAffiliations: OWNER) {
+                    pageInfo { hasNextPage endCursor }
+                    nodes {
+                        name
+                        url
+                        pushedAt
+                        defaultBranchRef { name }
+                        refs(refPrefix: "refs/tags/", first: 1, orderBy: {field: TAG_COMMIT_DATE, direction: DESC}) {
+                            nodes { name }
+                        }
+                    }
+                }
+            }
+        }
+    '''
+    session = None
 
     def start_backup(self):
         """
         Start backup.
         """
+        # ETags and last pushes of the previous backup
+        self.cache = SQLiteCache(self.alias)
+
+        self.session = requests.Session()
+        self.session.auth = (self.config.get('username'), self.config.get('token'))
+
         # Get all repositories
-        repositories = self.get_repositories()
+        with self.phase('listing'):
+            if self.config.get('graphql'):
+                repositories = self.get_repositories_graphql()
+            else:
+                repositories = self.get_repositories()
 
-        for repository in repositories:
+        with self.phase('transfer'):
             if self.config.get('archive'):
-                self.archive(repository, True)
+                for repository in repositories:
+                    self.archive(repository, True)
             else:
-                self.sync(repository)
+                self.sync_all(repositories)
 
     def get_repositories(self, page_url=''):
         """
@@ -36,19 +69,119 @@ class Github(Strategy):
         """
         repositories = []
         url = page_url if page_url else '{api_url}/users/{username}/repos'.format(api_url=self.API_URL, username=self.config.get('username'))
-        res = requests.get(url, auth=(self.config.get('username'), self.config.get('token')))
+        res = self.request(url)
 
-        if res.status_code == 200:
-            for repository in res.json():
+        if res['status'] == 200:
+            for repository in res['body']:
                 repositories.append(repository)
 
-        next_page_url = self.get_next_page_url(res.headers)
+        next_page_url = self.get_next_page_url(res['headers'])
 
         if next_page_url:
             repositories.extend(self.get_repositories(next_page_url))
 
         return repositories
 
+    def get_repositories_graphql(self):
+        """
+        Get all repositories including their latest tag using GraphQL.
+
+        Takes one request per 100 repositories. The result has the same
+        format as the REST API's, with the tags included.
+
+        @return list
+        """
+        repositories = []
+        after = None
+
+        while True:
+            self.metrics.add('api_calls')
+            res = self.session.post(self.API_URL + '/graphql', json={
+                'query': self.GRAPHQL_QUERY,
+                'variables': {'login': self.config.get('username'), 'after': after}
+            })
+
+            body = res.json()
+
+            if res.status_code != 200 or 'errors' in body:
+                raise Exception('Error getting repositories: ' + str(body.get('errors', body)))
+
+            page = body['data']['user']['repositories']
+
+            for node in page['nodes']:
+                tags = [tag['name'] for tag in node['refs']['nodes']]
+
+                repositories.append({
+                    'name': node['name'],
+                    'clone_url': node['url'] + '.git',
+                    'default_branch': node['defaultBranchRef']['name'] if node['defaultBranchRef'] else 'master',
+                    'pushed_at': node['pushedAt'],
+                    'tags': [{
+                        'name': tag,
+                        'zipball_url': '{}/repos/{}/{}/zipball/refs/tags/{}'.format(self.API_URL, self.config.get('username'), node['name'], tag)
+                    } for tag in tags]
+                })
+
+            if not page['pageInfo']['hasNextPage']:
+                return repositories
+
+            after = page['pageInfo']['endCursor']
+
+    def get_tags(self, repository):
+        """
+        Get tags of repository, unless they came with the repository already.
+
+        @param dict repository
+        @return list
+        """
+        if 'tags' in repository:
+            return repository['tags']
+
+        return self.request(repository['tags_url'])['body']
+
+    def request(self, url):
+        """
+        Send conditional GET request.
+
+        Responses are cached with their ETag. If GitHub answers
+        304 Not Modified, the cached response is used instead.
+        Those requests don't count against the rate limit.
+
+        @param string url
+        @return dict
+        """
+        cached = self.cache.get_meta('etag.' + url)
+        headers = {'If-None-Match': cached['etag']} if cached else {}
+
+        res = self.session.get(url, headers=headers)
+        self.metrics.add('api_calls')
+
+        if res.status_code == 304:
+            return dict(cached, status=200, modified=False)
+
+        response = {
+            'status': res.status_code,
+            'headers': {'Link': res.headers['Link']} if 'Link' in res.headers else {},
+            'body': res.json(),
+            'modified': True
+        }
+
+        if res.status_code == 200 and 'ETag' in res.headers:
+            self.cache.set_meta('etag.' + url, dict(response, etag=res.headers['ETag']))
+
+        return response
+
+    def is_unchanged(self, repository):
+        """
+        Check if repository has not been pushed to since the last backup.
+
+        @param dict repository
+        @return boolean
+        """
+        cached = self.cache.get(repository['name'])
+
+        return bool(cached) and cached.get('modified') == repository.get('pushed_at')
+
     def get_next_page_url(self, headers):
         """
         Get next page URL.
@@ -68,7 +201,7 @@ class Github(Strategy):
         @param dict repository
         @return dict
         """
-        res = requests.get(repository['tags_url'], auth=(self.config.get('username'), self.config.get('token'))).json()
+        res = self.get_tags(repository)
 
         version = res[0]['name'] if len(res) > 0 and 'name' in res[0] else None
         url = res[0]['zipball_url'] if len(res) > 0 and 'zipball_url' in res[0] else 'https://github.com/{}/{}/archive/{}.zip'.format(self.config.get('username'), repository['name'], repository['default_branch'])
@@ -82,7 +215,7 @@ class Github(Strategy):
         @param string repository
         @return string
         """
-        tags = requests.get(repository['tags_url'], auth=(self.config.get('username'), self.config.get('token'))).json()
+        tags = self.get_tags(repository)
 
         return tags[0]['name'] if len(tags) > 0 and 'name' in tags[0] else '1.0'
 
@@ -104,6 +237,12 @@ class Github(Strategy):
         @param dict repository
         @param boolean check_if_exists (optional)
         """
+        # Skip if nothing has been pushed since the last backup
+        cached = self.cache.get(repository['name'])
+
+        if check_if_exists and self.is_unchanged(repository) and os.path.isfile(cached.get('path', '')):
+            return
+
         # Get current version
         version = self.get_current_version(repository)
         
@@ -115,6 +254,7 @@ class Github(Strategy):
 
         # Check if file exists
         if check_if_exists and os.path.isfile(os.path.join(self.backup_path, filename)):
+            self.cache.set(repository['name'], modified=repository.get('pushed_at'), path=os.path.join(self.backup_path, filename))
             return
 
         # Get URL
@@ -123,38 +263,74 @@ class Github(Strategy):
         # Delete older version
         self.delete_older_versions(self.backup_path, repository['name'])
 
+        self.logger.info('Archiving {} ({})...'.format(repository['name'], version['number']))
+
         # Actually download the file
-        passman = urllib.request.HTTPPasswordMgrWithDefaultRealm()
-        passman.add_password(None, url, self.config.get('username'), self.config.get('token'))
-        authhandler = urllib.request.HTTPBasicAuthHandler(passman)
-        opener = urllib.request.build_opener(authhandler)
-        urllib.request.install_opener(opener)
+        res = self.session.get(url, stream=True)
+        self.metrics.add('api_calls')
 
-        self.logger.info('Archiving {} ({})...'.format(repository['name'], version['number']))
+        if res.status_code != 200:
+            res.close()
+            self.logger.error('URL {} could not be downloaded ({})'.format(url, res.status_code))
+            return
 
-        try:
-            with urllib.request.urlopen(url) as response, open(os.path.join(self.backup_path, filename), 'wb') as out_file:
-                data = response.read()
-                out_file.write(data)
-        except urllib.error.HTTPError as err:
-            if err.code == 404:
-                self.logger.error('URL {} not found (404)'.format(url))
+        download.save(res, os.path.join(self.backup_path, filename), self.logger,
+                      self.config.get('download_chunk_size', 1024 * 1024), metrics=self.metrics)
+
+        self.cache.set(repository['name'], modified=repository.get('pushed_at'), path=os.path.join(self.backup_path, filename))
+
+    def sync_all(self, repositories):
+        """
+        Clone or pull repositories, running up to 'sync_workers' git processes at once.
+
+        @param list repositories
+        """
+        with ThreadPoolExecutor(max_workers=self.config.get('sync_workers', 4)) as executor:
+            results = list(executor.map(self.sync, repositories))
+
+        failed = [result for result in results if not result['ok']]
+        self.metrics.add('files', len(results) - len(failed))
+
+        for result in failed:
+            self.logger.error('Error synchronizing {}: {} STDOUT: {})'.format(result['name'], result['stderr'], result['stdout']))
+
+        self.logger.info('Synchronized {} of {} repositories'.format(len(results) - len(failed), len(results)))
 
     def sync(self, repository):
         """
         Clone or pull repository.
 
         @param dict repository
+        @return dict Result with git output
         """
-        # Get current version
-        version = self.get_current_version(repository)
+        mirror = self.config.get('mirror')
+        path = os.path.join(self.backup_path, repository['name'] + ('.git' if mirror else ''))
+
+        # Skip if nothing has been pushed since the last backup
+        if self.is_unchanged(repository) and os.path.exists(path):
+            self.logger.info('{} is up-to-date'.format(repository['name']))
+            return {'name': repository['name'], 'ok': True, 'stderr': '', 'stdout': ''}
+
+        # Latest tag, if it came with the repository (requesting it only for logging isn't worth it)
+        label = repository['name'] + (' ({})'.format(repository['tags'][0]['name']) if repository.get('tags') else '')
 
         try:
-            if os.path.exists(os.path.join(self.backup_path, repository['name'])):
-                self.logger.info('Pulling {} ({})...'.format(repository['name'], version['number']))
+            if mirror:
+                self.logger.info('Mirroring {}...'.format(label))
+                git.mirror(repository['clone_url'], path)
+                git.gc_if_due(path, self.cache, repository['name'], self.config.get('gc_interval'))
+            elif os.path.exists(path):
+                self.logger.info('Pulling {}...'.format(label))
                 subprocess.run(['git', '-C', os.path.join(self.backup_path, repository['name']), 'pull', '--rebase', repository['clone_url']], check=True, capture_output=True)
             else:
-                self.logger.info('Cloning {} ({})...'.format(repository['name'], version['number']))
+                self.logger.info('Cloning {}...'.format(label))
                 subprocess.run(['git', '-C', self.backup_path, 'clone', repository['clone_url']], check=True, capture_output=True)
         except subprocess.CalledProcessError as err:
-            self.logger.error('Error synchronizing repo: {} STDOUT: {})'.format(err.stderr.decode('utf-8'), err.stdout.decode('utf-8')))
+            return {'name': repository['name'], 'ok': False, 'stderr': err.stderr.decode('utf-8'), 'stdout': err.stdout.decode('utf-8')}
+        except Exception as err:
+            # Report per repository instead of aborting all others
+            return {'name': repository['name'], 'ok': False, 'stderr': str(err), 'stdout': ''}
+
+        self.cache.set(repository['name'], modified=repository.get('pushed_at'), path=path)
+
+        return {'name': repository['name'], 'ok': True, 'stderr': '', 'stdout': ''}
@@ -1,7 +1,8 @@
 """Backup strategy for Google Drive."""
 
 from helpers.strategy import Strategy
-from helpers.cache import Cache
+from helpers.cache import SQLiteCache
+from helpers.download import Downloader
 from helpers import util
 import os
 from datetime import datetime
@@ -10,7 +11,7 @@ import json
 import webbrowser
 from urllib.parse import quote_plus
 import requests
-import urllib3
+import shutil
 from pathlib import Path
 
 
@@ -24,7 +25,9 @@ class GoogleDrive(Strategy):
     NAME = 'Google Drive'
     TYPE = 'googledrive'
     API_URL = 'https://www.googleapis.com/drive/v3/files'
+    CHANGES_URL = 'https://www.googleapis.com/drive/v3/changes'
     cache = None
+    downloader = None
 
     def add(self):
         """Add Google Drive account."""
@@ -47,25 +50,223 @@ class GoogleDrive(Strategy):
     def start_backup(self):
         """Start backup."""
         # Set cache
-        self.cache = Cache(self.alias)
-
-        # Backup
-        self.get_children()
+        self.cache = SQLiteCache(self.alias)
+
+        # Listing queues downloads which are handled by a pool of workers
+        self.downloader = Downloader(self.logger,
+                                     self.config.get('download_workers', 4),
+                                     self.config.get('download_chunk_size', 1024 * 1024),
+                                     self.get_auth_header,
+                                     metrics=self.metrics)
+
+        # Incremental backups continue from the last changes page token
+        incremental = self.config.get('incremental')
+
+        # Every version is a new folder, which only a full scan fills completely
+        if incremental and self.backup_path != self.config.get('backup_path'):
+            self.logger.warning('Incremental backups require versions to be unset or 1, doing a full scan')
+            incremental = False
+
+        if not incremental:
+            # Changes are not followed by this backup, so the token goes stale
+            self.cache.set_meta('changes_page_token', None)
+
+        page_token = self.cache.get_meta('changes_page_token') if incremental else None
+        full_scan = not page_token
+        errors = self.get_error_count()
+
+        # Backup (API requests are timed as listing, each download as transfer)
+        try:
+            if full_scan:
+                if incremental:
+                    # Get token before listing, so no change can get lost
+                    page_token = self.get_start_page_token()
+                    self.cache.set(self.get_root_id(), path=self.backup_path,
+                                   folder=True, last_seen=util.startup_time)
+
+                if self.config.get('flat_scan'):
+                    self.get_all_children()
+                else:
+                    self.get_children()
+            else:
+                page_token = self.get_changes(page_token)
+        finally:
+            # Wait for downloads still queued after listing
+            self.downloader.wait()
 
         # Cleanup
-        self.cleanup()
+        if full_scan:
+            with self.phase('cleanup'):
+                self.cleanup()
+
+        # Remember where to continue, unless changes may have been missed
+        if incremental and self.get_error_count() == errors:
+            self.cache.set_meta('changes_page_token', page_token)
 
     def cleanup(self):
         """Delete files that have been removed from Drive."""
-        all_cached = self.cache.get()
+        stale = self.cache.get_stale(util.startup_time)
+        folders = []
 
-        for id, item in list(all_cached.items()):
-            if item['last_seen'] is not util.startup_time and 'path' in item:
+        for item in stale:
+            if item.get('folder'):
+                folders.append(item['path'])
+            elif 'path' in item:
                 # Delete file
                 Path(item['path']).unlink(missing_ok=True)
 
-                # Remove item from cache
-                self.cache.delete(id)
+        # Delete folders that are empty now, deepest first
+        for folder in sorted(folders, key=len, reverse=True):
+            try:
+                os.rmdir(folder)
+            except OSError:
+                pass
+
+        # Remove items from cache
+        self.cache.delete_many([item['id'] for item in stale])
+
+    def get_start_page_token(self):
+        """Get changes page token for the current state of the Drive.
+
+        @return string
+        """
+        res = self.execute_request(self.CHANGES_URL + '/startPageToken', {})
+
+        if res['status'] != 200:
+            raise Exception('Error getting start page token: ' + str(res['body']))
+
+        return res['body']['startPageToken']
+
+    def get_root_id(self):
+        """Get id of the root folder.
+
+        @return string
+        """
+        res = self.execute_request(self.API_URL + '/root', {}, {'fields': 'id'})
+
+        if res['status'] != 200:
+            raise Exception('Error getting root folder: ' + str(res['body']))
+
+        return res['body']['id']
+
+    def get_changes(self, page_token):
+        """Apply all changes since the last backup.
+
+        @param string page_token
+        @return string Page token for the next backup
+        """
+        changes = []
+
+        while True:
+            params = {
+                'pageToken': page_token,
+                'pageSize': '1000',
+                'spaces': 'drive',
+                'fields': 'nextPageToken,newStartPageToken,changes(fileId,removed,file(id,name,mimeType,modifiedTime,trashed,parents))'
+            }
+
+            res = self.execute_request(self.CHANGES_URL, {}, params)
+
+            if res['status'] != 200:
+                raise Exception('Error getting changes: ' + str(res['body']))
+
+            changes.extend(res['body']['changes'])
+
+            if 'nextPageToken' not in res['body']:
+                break
+
+            page_token = res['body']['nextPageToken']
+
+        self.logger.info('Applying {} change(s)...'.format(len(changes)))
+
+        # Apply folders first (parents before children), then files
+        folders = [change for change in changes if 'file' in change and self.is_folder(change['file'])]
+        folder_ids = {change['fileId'] for change in folders}
+        files = [change for change in changes if change['fileId'] not in folder_ids]
+
+        while folders:
+            postponed = [change for change in folders if not self.apply_change(change)]
+
+            if len(postponed) == len(folders):
+                break
+
+            folders = postponed
+
+        for change in files + folders:
+            self.apply_change(change, True)
+
+        return res['body']['newStartPageToken']
+
+    def apply_change(self, change, final=False):
+        """Apply a single change.
+
+        @param dict change
+        @param boolean final (optional) Whether the change may not be postponed
+        @return boolean False if the parent folder is not known (yet)
+        """
+        item = change.get('file')
+        cached = self.cache.get(change['fileId'])
+
+        # Removed or trashed
+        if change.get('removed') or item['trashed']:
+            self.remove_item(cached)
+            return True
+
+        parent = self.cache.get(item['parents'][0]) if item.get('parents') else None
+
+        if not parent or not parent.get('folder'):
+            if not final:
+                return False
+
+            # Moved out of the backed up tree
+            self.remove_item(cached)
+            return True
+
+        parent_path = os.path.relpath(parent['path'], self.backup_path)
+        parents = [] if parent_path == '.' else parent_path.split(os.sep)
+
+        # Move folder with all its content
+        if self.is_folder(item) and cached and cached['path'] != os.path.join(parent['path'], item['name']):
+            move_target = os.path.join(parent['path'], item['name'])
+
+            if os.path.exists(cached['path']):
+                self.logger.info('Moving {} to {}'.format(cached['path'], move_target))
+                os.makedirs(parent['path'], exist_ok=True)
+                os.rename(cached['path'], move_target)
+
+            self.cache.move_path(cached['path'], move_target)
+
+        destination = self.process_item(item, parents, False)
+
+        # Modified and moved, remove old version
+        if destination and cached and not cached.get('folder') and \
+                cached.get('path') not in [None, destination]:
+            Path(cached['path']).unlink(missing_ok=True)
+
+        if destination:
+            self.cache.set(item['id'], last_seen=util.startup_time)
+        else:
+            self.remove_item(cached)
+
+        return True
+
+    def remove_item(self, cached):
+        """Delete backed up file or folder.
+
+        @param dict cached
+        """
+        if not cached or 'path' not in cached:
+            return
+
+        self.logger.info('Deleting {}'.format(cached['path']))
+
+        if cached.get('folder'):
+            shutil.rmtree(cached['path'], ignore_errors=True)
+            self.cache.delete_path(cached['path'])
+        else:
+            Path(cached['path']).unlink(missing_ok=True)
+
+        self.cache.delete(cached['id'])
 
     def build_auth_uri(self):
         """Build auth URI for requesting token.
@@ -119,16 +320,23 @@ class GoogleDrive(Strategy):
             }
             headers.update(auth_header)
 
-        # Execute request
-        if method == 'GET':
-            res = requests.get(url, headers=headers, params=params)
-        else:
-            res = requests.post(url, headers=headers, data=params)
+        # Execute request, downloads are timed by the downloader instead
+        with self.phase('listing'):
+            if method == 'GET':
+                res = requests.get(url, headers=headers, params=params)
+            else:
+                res = requests.post(url, headers=headers, data=params)
+
+        if self.metrics:
+            self.metrics.add('api_calls')
 
         # Permission error
         if res.status_code == 401:
             # Maybe the token is expired
             if not is_retry:
+                if self.metrics:
+                    self.metrics.add('retries')
+
                 # Refresh token
                 self.config.set('token', self.request_token())
 
@@ -144,6 +352,15 @@ class GoogleDrive(Strategy):
             'body': res.json()
         }
 
+    def get_auth_header(self):
+        """Get Authorization-Header for the current access token.
+
+        @return dict
+        """
+        return {
+            'Authorization': 'Bearer {}'.format(self.config.get('token')['access_token'])
+        }
+
     def request_token(self, code=''):
         """Request access token.
 
@@ -255,9 +472,6 @@ class GoogleDrive(Strategy):
         @param list parents (optional)
         @param string page_token (optional)
         """
-        path_server = '/' + '/'.join(parents).strip('/')
-        path = os.path.join(self.backup_path, path_server.strip('/'))
-
         params = {
             'q': "'" + item_id + "' in parents",
             'fields': 'nextPageToken,files(id,name,mimeType,modifiedTime,trashed)',
@@ -280,61 +494,122 @@ class GoogleDrive(Strategy):
 
         items = res['body']['files'] if res['status'] == 200 else []
 
-        for item in items:
-            url = self.API_URL + '/' + item['id'] + '?alt=media'
-            path_item = os.path.join(path_server, item['name'])
-            filename = item['name']
+        seen = [item['id'] for item in items if self.process_item(item, parents)]
 
-            # Excluded or trashed
-            if self.check_if_excluded(path_item):
-                continue
+        # Remember last seen in cache
+        self.cache.set_many([(item_id, {'last_seen': util.startup_time}) for item_id in seen])
 
-            if item['trashed']:
-                continue
+        if 'nextPageToken' in res['body']:
+            self.get_children(item_id, parents, res['body']['nextPageToken'])
 
-            # Folders
-            if self.is_folder(item):
-                self.get_children(item['id'], parents + [item['name']])
-                continue
-
-            # Google Docs
-            if self.is_google_doc(item):
-                url = self.API_URL + '/' + \
-                    item['id'] + '/export?mimeType=application/pdf'
-                filename = item['name'] + '_converted.pdf'
-            # Google Spreadsheets
-            elif self.is_google_sheet(item):
-                url = self.API_URL + '/' + \
-                    item['id'] + '/export?mimeType=application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-                filename = item['name'] + '.xlsx'
-            # Google Slides
-            elif self.is_google_slides(item):
-                url = self.API_URL + '/' + \
-                    item['id'] + '/export?mimeType=application/pdf'
-                filename = item['name'] + '_converted.pdf'
+    def get_all_children(self):
+        """List the whole Drive at once and traverse the tree in memory.
+
+        Takes one request per 1000 items instead of one per folder.
+        """
+        children = {}
+        page_token = ''
+
+        while True:
+            params = {
+                'q': 'trashed = false',
+                'fields': 'nextPageToken,files(id,name,mimeType,modifiedTime,trashed,parents)',
+                'pageSize': '1000'
+            }
+
+            if page_token:
+                params['pageToken'] = page_token
+
+            res = self.execute_request(self.API_URL, {}, params)
+
+            if res['status'] != 200:
+                raise Exception('Error listing files: ' + str(res['body']))
+
+            for item in res['body']['files']:
+                for parent in item.get('parents', []):
+                    children.setdefault(parent, []).append(item)
+
+            if 'nextPageToken' not in res['body']:
+                break
+
+            page_token = res['body']['nextPageToken']
+
+        self.logger.info('Listed {} item(s)'.format(sum(len(items) for items in children.values())))
+
+        # Items not below root (e.g. shared with me) are never reached
+        folders = [(self.get_root_id(), [])]
+
+        while folders:
+            folder_id, parents = folders.pop()
+            seen = []
+
+            for item in children.pop(folder_id, []):
+                if not self.process_item(item, parents, False):
+                    continue
+
+                seen.append(item['id'])
+
+                if self.is_folder(item):
+                    folders.append((item['id'], parents + [item['name']]))
 
             # Remember last seen in cache
-            self.cache.set(item['id'] + '.last_seen', util.startup_time)
+            self.cache.set_many([(item_id, {'last_seen': util.startup_time}) for item_id in seen])
 
-            # Move if moved
-            if self.check_if_moved_and_move(item, path, filename):
-                continue
+    def process_item(self, item, parents, recursive=True):
+        """Back up a single item.
 
-            # Download
-            if not self.is_backed_up(item, path, filename):
-                try:
-                    self.download(url, path, filename)
+        @param GoogleDriveFile item
+        @param list parents Names of the parent folders
+        @param boolean recursive (optional) Whether to traverse folders
+        @return string Local path or None if the item is not backed up
+        """
+        path_server = '/' + '/'.join(parents).strip('/')
+        path = os.path.join(self.backup_path, path_server.strip('/'))
+        url = self.API_URL + '/' + item['id'] + '?alt=media'
+        path_item = os.path.join(path_server, item['name'])
+        filename = item['name']
 
-                    # Add to cache
-                    self.cache.set(item['id'] + '.modified',
-                                   item['modifiedTime'])
-                    self.cache.set(item['id'] + '.path',
-                                   os.path.join(path, filename))
-                except Exception as e:
-                    self.logger.error(e)
+        # Excluded or trashed
+        if self.check_if_excluded(path_item):
+            return None
 
-        if 'nextPageToken' in res['body']:
-            self.get_children(item_id, parents, res['body']['nextPageToken'])
+        if item['trashed']:
+            return None
+
+        # Folders
+        if self.is_folder(item):
+            self.cache.set(item['id'], path=os.path.join(path, item['name']), folder=True)
+
+            if recursive:
+                self.get_children(item['id'], parents + [item['name']])
+
+            return os.path.join(path, item['name'])
+
+        # Google Docs
+        if self.is_google_doc(item):
+            url = self.API_URL + '/' + \
+                item['id'] + '/export?mimeType=application/pdf'
+            filename = item['name'] + '_converted.pdf'
+        # Google Spreadsheets
+        elif self.is_google_sheet(item):
+            url = self.API_URL + '/' + \
+                item['id'] + '/export?mimeType=application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+            filename = item['name'] + '.xlsx'
+        # Google Slides
+        elif self.is_google_slides(item):
+            url = self.API_URL + '/' + \
+                item['id'] + '/export?mimeType=application/pdf'
+            filename = item['name'] + '_converted.pdf'
+
+        # Move if moved
+        if self.check_if_moved_and_move(item, path, filename):
+            return os.path.join(path, filename)
+
+        # Download
+        if not self.is_backed_up(item, path, filename):
+            self.download(url, path, filename, item)
+
+        return os.path.join(path, filename)
 
     def check_if_moved_and_move(self, item, path, filename):
         """Check if source was simply moved and move if so.
@@ -362,7 +637,7 @@ class GoogleDrive(Strategy):
                     move_source['path'], move_target))
                 os.rename(move_source['path'], move_target)
 
-                self.cache.set(item['id'] + '.' + 'path', move_target)
+                self.cache.set(item['id'], path=move_target)
 
                 return True
 
@@ -385,39 +660,19 @@ class GoogleDrive(Strategy):
 
         return False
 
-    def download(self, url, path, filename):
-        """Download item.
+    def download(self, url, path, filename, item):
+        """Queue item for download and add it to cache once downloaded.
 
         @param string url
         @param string path
         @param string filename
+        @param GoogleDriveFile item
         """
-        # Create folder if not exists
-        if not os.path.exists(path):
-            os.makedirs(path)
+        destination = os.path.join(path, filename)
 
-        headers = {
-            'Authorization': 'Bearer {}'.format(self.config.get('token')['access_token'])
-        }
-
-        # Download file
-        self.logger.info('Downloading {}...'.format(
-            os.path.join(path, filename)))
-
-        http = urllib3.PoolManager()
-        res = http.request('GET', url, headers=headers, preload_content=False)
+        def add_to_cache():
+            self.cache.set(item['id'],
+                           modified=item['modifiedTime'],
+                           path=destination)
 
-        if res.status == 200:
-            self.logger.info('Downloaded.')
-
-            with open(os.path.join(path, filename), 'wb') as out:
-                while True:
-                    data = res.read(128)
-                    if not data:
-                        break
-                    out.write(data)
-
-            res.release_conn()
-        else:
-            raise Exception(
-                'Download failed ({}) -> {}'.format(res.status, str(res.data)))
+        self.downloader.submit(url, destination, add_to_cache)
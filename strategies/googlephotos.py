@@ -3,15 +3,18 @@
 import os
 import re
 import json
+import shutil
 from urllib.parse import quote_plus
 import webbrowser
 import requests
-import urllib3
 
 # Prevent SSL certificate errors
 from urllib3.contrib import pyopenssl
 pyopenssl.extract_from_urllib3()
 
+from helpers import util
+from helpers.cache import SQLiteCache
+from helpers.download import Downloader
 from helpers.strategy import Strategy
 
 class GooglePhotos(Strategy):
@@ -19,6 +22,11 @@ class GooglePhotos(Strategy):
     NAME = 'Google Photos'
     TYPE = 'googlephotos'
     API_URL = 'https://photoslibrary.googleapis.com/v1'
+    downloader = None
+    in_progress = {}
+    in_progress_destinations = set()
+    deferred_links = []
+    album_counts = {}
 
     def add(self):
         """Add Google Photos account."""
@@ -45,14 +53,65 @@ class GooglePhotos(Strategy):
         """
         self.logger.info('Getting albums...')
 
+        # Index of backed up media items
+        self.cache = SQLiteCache(self.alias)
+        self.in_progress = {}
+        self.in_progress_destinations = set()
+        self.deferred_links = []
+        self.album_counts = {}
+        errors = self.get_error_count()
+
         # Get all albums
         albums = self.get_albums()
 
-        # Backup albums
-        for album in albums:
-            if not self.check_if_excluded(album['title']):
+        # Scanning queues downloads which are handled by a pool of workers
+        self.downloader = Downloader(self.logger,
+                                     self.config.get('download_workers', 4),
+                                     self.config.get('download_chunk_size', 1024 * 1024),
+                                     self.get_auth_header,
+                                     True,
+                                     self.metrics)
+
+        # Backup albums (API requests are timed as listing, each download as transfer)
+        try:
+            for album in albums:
+                if self.check_if_excluded(album['title']):
+                    continue
+
+                if self.is_unchanged(album):
+                    self.logger.info('{} is unchanged'.format(album['title']))
+                    continue
+
                 self.logger.info('Scanning {} for new items...'.format(album['title']))
                 self.get_album_content(album['id'], album['title'])
+                self.album_counts[album['id']] = album.get('mediaItemsCount')
+        finally:
+            # Wait for downloads still queued after scanning
+            self.downloader.wait()
+
+        # Link items that were being downloaded when they showed up in another album
+        for source, destination, key in self.deferred_links:
+            self.link(source, destination, key)
+
+        # Remember album sizes, unless items may have been missed
+        if self.get_error_count() == errors:
+            for album_id, count in self.album_counts.items():
+                self.cache.set_meta('album.' + album_id, count)
+
+    def is_unchanged(self, album):
+        """
+        Check if album has the same number of items as in the last backup.
+
+        Only used if 'skip_unchanged_albums' is set, because an album
+        where items have been replaced keeps its size.
+
+        @param dict album
+        @return boolean
+        """
+        if not self.config.get('skip_unchanged_albums') or 'mediaItemsCount' not in album:
+            return False
+
+        return self.cache.get_meta('album.' + album['id']) == album['mediaItemsCount']
 
     def show_instructions(self):
         """
@@ -132,18 +191,25 @@ class GooglePhotos(Strategy):
             }
             headers.update(auth_header)
 
-        # Execute request
-        if method == 'GET':
-            res = requests.get(url, headers=headers, params=params)
-        elif method == 'POST':
-            res = requests.post(url, headers=headers, data=params)
-        elif method == 'HEAD':
-            res = requests.head(url, headers=headers)
+        # Execute request, downloads are timed by the downloader instead
+        with self.phase('listing'):
+            if method == 'GET':
+                res = requests.get(url, headers=headers, params=params)
+            elif method == 'POST':
+                res = requests.post(url, headers=headers, data=params)
+            elif method == 'HEAD':
+                res = requests.head(url, headers=headers)
+
+        if self.metrics:
+            self.metrics.add('api_calls')
 
         # Permission error
         if res.status_code == 401:
             # Maybe the token is expired
             if not is_retry:
+                if self.metrics:
+                    self.metrics.add('retries')
+
                 # Refresh token
                 self.config.set('token', self.request_token())
 
@@ -224,52 +290,137 @@ class GooglePhotos(Strategy):
 
             for item in items:
                 path = self.backup_path + '/' + year + '/' + name
-                filename = item['filename']
 
                 url_postfix = '=dv' if 'video' in item['mediaMetadata'] else '=w' + item['mediaMetadata']['width'] + '-h' + item['mediaMetadata']['height']
 
-                self.download(item['baseUrl'] + url_postfix, filename, path)
+                self.backup_item(item, album_id, path, item['baseUrl'] + url_postfix)
 
         if 'nextPageToken' in res['body']:
             self.get_album_content(album_id, name, res['body']['nextPageToken'])
 
-    def download(self, url, filename, path):
+    def backup_item(self, item, album_id, path, url):
         """
-        Download item.
+        Back up media item to album folder.
 
+        The index holds one entry per media item and one per album it is in.
+        Items already backed up to another album are hardlinked.
+
+        @param dict item
+        @param string album_id
+        @param string path
         @param string url
-        @param string filename
+        """
+        key = album_id + '/' + item['id']
+        member = self.cache.get(key)
+
+        # Already in this album's folder (which changes on rename and for every version)
+        if member and os.path.dirname(member['path']) == path and os.path.isfile(member['path']):
+            return
+
+        known = self.cache.get(item['id'])
+
+        if known and not os.path.isfile(known['path']):
+            self.logger.warning('{} is missing, downloading again'.format(known['path']))
+            self.cache.delete(item['id'])
+            known = None
+
+        destination = self.get_destination(item, path)
+
+        if known:
+            self.link(known['path'], destination, key)
+        elif item['id'] in self.in_progress:
+            self.deferred_links.append((self.in_progress[item['id']], destination, key))
+        elif os.path.isfile(destination):
+            # Backed up before the index existed
+            self.add_to_index(item, destination, key)
+        else:
+            self.in_progress[item['id']] = destination
+            self.in_progress_destinations.add(destination)
+            self.download(url, destination, item, key)
+
+    def get_destination(self, item, path):
+        """
+        Determine destination, avoiding clashes of items with the same filename.
+
+        @param dict item
         @param string path
+        @return string
         """
-        # Create folder if not exists
-        if not os.path.exists(path):
-            os.makedirs(path)
+        destination = os.path.join(path, item['filename'])
+        owner = self.cache.find(destination)
 
-        headers = {
-            'Authorization': 'Bearer {}'.format(self.config.get('token')['access_token'])
-        }
+        if (owner and owner['id'].split('/')[-1] != item['id']) or \
+                destination in self.in_progress_destinations:
+            name, ext = os.path.splitext(item['filename'])
+            destination = os.path.join(path, '{}_{}{}'.format(name, util.md5(item['id'])[:8], ext))
+
+        return destination
 
-        # Check if file already exists
-        if os.path.isfile(os.path.join(path, filename)):
+    def link(self, source, destination, key):
+        """
+        Hardlink already backed up item into another album.
+
+        The item is indexed at its newest copy, so it stays known
+        when older versions are removed.
+
+        @param string source
+        @param string destination
+        @param string key
+        """
+        if not os.path.isfile(source):
+            self.logger.warning('{} is missing'.format(source))
             return
 
-        # Download file
-        http = urllib3.PoolManager()
-        res = http.request('GET', url, headers=headers, preload_content=False)
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
 
-        if res.status == 200:
-            self.logger.info('Downloading {} -> {}'.format(os.path.basename(path), filename))
+        if not os.path.exists(destination):
+            try:
+                os.link(source, destination)
+            except OSError:
+                shutil.copy2(source, destination)
 
-            with open(os.path.join(path, filename), 'wb') as out:
-                while True:
-                    data = res.read(128)
-                    if not data:
-                        break
-                    out.write(data)
+        self.cache.set_many([
+            (key.split('/')[-1], {'path': destination}),
+            (key, {'path': destination})
+        ])
 
-            res.release_conn()
-        else:
-            self.logger.error('Error downloading ({}) -> {}'.format(str(res.status), str(res.data)))
+    def add_to_index(self, item, destination, key):
+        """
+        Add downloaded item to index.
+
+        @param dict item
+        @param string destination
+        @param string key
+        """
+        self.cache.set_many([
+            (item['id'], {
+                'path': destination,
+                'size': os.path.getsize(destination),
+                'modified': item['mediaMetadata'].get('creationTime')
+            }),
+            (key, {'path': destination})
+        ])
+
+    def download(self, url, destination, item, key):
+        """
+        Queue item for download and add it to index once downloaded.
+
+        @param string url
+        @param string destination
+        @param dict item
+        @param string key
+        """
+        self.downloader.submit(url, destination, lambda: self.add_to_index(item, destination, key))
+
+    def get_auth_header(self):
+        """
+        Get Authorization-Header for the current access token.
+
+        @return dict
+        """
+        return {
+            'Authorization': 'Bearer {}'.format(self.config.get('token')['access_token'])
+        }
 
     def create_album(self, name):
         """
@@ -1,8 +1,15 @@
 """Backup strategy for MongoDB."""
 
+import os
+import re
+import json
+import shlex
+import shutil
 import subprocess
+from datetime import datetime, timedelta
 
 from helpers.strategy import Strategy
+from helpers.cache import SQLiteCache
 
 from helpers import util
 
@@ -15,8 +22,28 @@ class MongoDB(Strategy):
         """
         Start backup.
         """
-        # Download database
-        self.download(self.config.get('db_name'), self.config.get('db_host'), self.config.get('db_port'), self.config.get('db_user'), self.config.get('db_pass'), self.backup_path)
+        if self.config.get('incremental'):
+            self.cache = SQLiteCache(self.alias)
+            self.backup_incremental()
+        else:
+            # Download database
+            self.download(self.config.get('db_name'), self.config.get('db_host'), self.config.get('db_port'), self.config.get('db_user'), self.config.get('db_pass'), self.backup_path)
+
+    def teardown(self):
+        """Clean up backup environment, keeping restore chains intact."""
+        if not self.config.get('incremental'):
+            return super().teardown()
+
+        if self.config.get('dedup'):
+            self.logger.warning('dedup is not supported for incremental backups, skipping')
+
+        if self.config.get('versions') and not self.multipart:
+            # Remove old chains
+            with self.phase('rotation'):
+                self.cleanup_chains(self.config.get('versions'))
+
+        # Done
+        self.logger.info('Done')
 
     def download(self, db_name, db_host, db_port, db_user, db_pass, path_to):
         """
@@ -38,7 +65,193 @@ class MongoDB(Strategy):
         if db_user and db_pass:
             cmd += ' --username {} --password "{}" --authenticationDatabase admin'.format(db_user, db_pass)
 
+        self.run(cmd)
+
+        self.metrics.add('bytes', util.get_size(os.path.join(path_to, filename)))
+        self.metrics.add('files')
+
+    def backup_incremental(self):
+        """
+        Take a full dump if due, otherwise dump the oplog since the last backup.
+
+        Every run is recorded in the current restore chain, which is kept in
+        the cache and written as chain.json next to each dump, along with
+        the commands to restore it.
+        """
+        chains = self.cache.get_meta('chains', [])
+        chain = chains[-1] if chains else None
+
+        # Determine destination relative to the alias' backup path
+        destination = os.path.join(self.backup_path, self.alias + '_' + util.startup_time)
+        name = os.path.relpath(destination, self.config.get('backup_path'))
+
+        # Oplog position before dumping, anything newer goes to the next increment
+        first, last = self.get_oplog_range()
+        full = self.is_full_due(chain, first)
+
+        try:
+            if full:
+                self.logger.info('Taking full dump')
+                self.download(self.config.get('db_name'), self.config.get('db_host'), self.config.get('db_port'), self.config.get('db_user'), self.config.get('db_pass'), self.backup_path)
+            else:
+                self.logger.info('Dumping oplog since {}'.format(chain['ts']))
+                self.download_oplog(chain['ts'], last, destination)
+        except Exception:
+            # Only folders recorded in a chain are ever rotated
+            util.remove(os.path.join(self.config.get('backup_path'), name.split(os.sep)[0]))
+            raise
+
+        if full:
+            chain = {
+                'full': name,
+                'created': datetime.now().isoformat(),
+                'incrementals': [],
+                'ts': last
+            }
+            chains.append(chain)
+        else:
+            chain['incrementals'].append({
+                'name': name,
+                'oplog': os.path.join(name, 'oplog.bson.gz'),
+                'from': chain['ts'],
+                'to': last
+            })
+            chain['ts'] = last
+
+        # Describe how to restore this dump
+        with open(os.path.join(destination, 'chain.json'), 'w') as fout:
+            fout.write(json.dumps(dict(chain, restore=self.get_restore_commands(chain)), indent=4))
+
+        self.cache.set_meta('chains', chains)
+
+    def is_full_due(self, chain, first):
+        """
+        Check whether a new full dump has to be taken.
+
+        @param dict chain
+        @param dict first Oldest timestamp in the oplog
+        @return boolean
+        """
+        if not chain:
+            return True
+
+        if not os.path.exists(os.path.join(self.config.get('backup_path'), chain['full'])):
+            self.logger.warning('Full dump {} is missing'.format(chain['full']))
+            return True
+
+        if datetime.now() - datetime.fromisoformat(chain['created']) >= timedelta(days=self.config.get('full_interval', 7)):
+            return True
+
+        if (first['t'], first['i']) > (chain['ts']['t'], chain['ts']['i']):
+            self.logger.warning('Oplog does not reach back to the last backup')
+            return True
+
+        return False
+
+    def get_oplog_range(self):
+        """
+        Get timestamps of the oldest and the newest oplog entries.
+
+        @return tuple
+        """
+        script = ('const oplog = db.getSiblingDB("local").oplog.rs;'
+                  'print(EJSON.stringify({'
+                  'first: oplog.find().sort({$natural: 1}).limit(1).next().ts,'
+                  'last: oplog.find().sort({$natural: -1}).limit(1).next().ts'
+                  '}));')
+
+        cmd = 'mongosh --quiet --host {} --port {}{} --eval {}'.format(self.config.get('db_host'), self.config.get('db_port'), self.get_auth_args(), shlex.quote(script))
+
+        try:
+            res = json.loads(self.run(cmd).strip().splitlines()[-1])
+        except (ValueError, IndexError) as err:
+            raise Exception('Could not read oplog. Incremental backups require a replica set') from err
+
+        return res['first']['$timestamp'], res['last']['$timestamp']
+
+    def download_oplog(self, start, end, destination):
+        """
+        Use mongodump to download the oplog entries of the database in (start, end].
+
+        @param dict start
+        @param dict end
+        @param string destination
+        """
+        query = {
+            'ts': {
+                '$gt': {'$timestamp': start},
+                '$lte': {'$timestamp': end}
+            },
+            'ns': {'$regex': '^{}\\.'.format(re.escape(self.config.get('db_name')))}
+        }
+
+        cmd = 'mongodump -h {} --port {} --db local --collection oplog.rs --query {} --gzip --out {}{}'.format(self.config.get('db_host'), self.config.get('db_port'), shlex.quote(json.dumps(query)), destination, self.get_auth_args())
+
+        self.run(cmd)
+
+        # mongorestore --oplogReplay expects the oplog at the root of the dump
+        os.replace(os.path.join(destination, 'local', 'oplog.rs.bson.gz'), os.path.join(destination, 'oplog.bson.gz'))
+        shutil.rmtree(os.path.join(destination, 'local'))
+
+        self.metrics.add('bytes', util.get_size(destination))
+        self.metrics.add('files')
+
+    def get_restore_commands(self, chain):
+        """
+        Get commands restoring a chain in order, run from the backup path.
+
+        @param dict chain
+        @return list
+        """
+        commands = ['mongorestore --gzip {}'.format(shlex.quote(chain['full']))]
+
+        for incremental in chain['incrementals']:
+            commands.append('mongorestore --gzip --oplogReplay {}'.format(shlex.quote(incremental['name'])))
+
+        return commands
+
+    def cleanup_chains(self, versions):
+        """
+        Remove all but the latest x chains of full dump and incrementals.
+
+        @param int versions
+        """
+        chains = self.cache.get_meta('chains', [])
+
+        for chain in chains[:-versions]:
+            names = [chain['full']] + [incremental['name'] for incremental in chain['incrementals']]
+
+            for name in names:
+                # Remove the whole version folder the dump is in
+                path = os.path.join(self.config.get('backup_path'), name.split(os.sep)[0])
+
+                if os.path.lexists(path):
+                    util.remove(path)
+
+        self.cache.set_meta('chains', chains[-versions:])
+
+    def get_auth_args(self):
+        """
+        Get authentication arguments for mongo tools.
+
+        @return string
+        """
+        if self.config.get('db_user') and self.config.get('db_pass'):
+            return ' --username {} --password "{}" --authenticationDatabase admin'.format(self.config.get('db_user'), self.config.get('db_pass'))
+
+        return ''
+
+    def run(self, cmd):
+        """
+        Run mongo tool.
+
+        @param string cmd
+        @return string STDOUT
+        """
         try:
-            subprocess.run([cmd], shell=True, check=True, capture_output=True)
+            with self.phase('dump'):
+                res = subprocess.run([cmd], shell=True, check=True, capture_output=True)
         except subprocess.CalledProcessError as err:
             raise Exception('Error downloading: {} STDOUT: {})'.format(err.stderr.decode('utf-8'), err.stdout.decode('utf-8'))) from err
+
+        return res.stdout.decode('utf-8')
@@ -1,11 +1,17 @@
 """Backup strategy for MySQL."""
 
-import subprocess
+import os
 import re
+import json
+import shlex
+import subprocess
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 from helpers.strategy import Strategy
 
 from helpers import util
+from helpers import compression
 
 class MySQL(Strategy):
     """Backup strategy for MySQL."""
@@ -36,9 +42,109 @@ class MySQL(Strategy):
         # Determine filename
         filename = self.alias + '_' + util.startup_time
 
+        credentials = '-h {} -P {} -u {} -p{}'.format(db_host, db_port, db_user, db_pass)
+
+        with self.phase('dump'):
+            if self.config.get('parallel_tables', 1) > 1:
+                self.dump_tables(db_name, credentials, os.path.join(path_to, filename))
+            else:
+                self.dump(db_name, credentials, os.path.join(path_to, filename))
+
+    def dump(self, db_name, credentials, destination, table=''):
+        """
+        Dump database or a single table, compressed if configured.
+
+        The dump is streamed through the compressor, so the uncompressed
+        SQL never hits the disk.
+
+        @param string db_name
+        @param string credentials
+        @param string destination Path without extension
+        @param string table (optional)
+        @return string Path of the dump
+        """
+        method = self.config.get('compression')
+        destination += '.sql' + compression.get_extension(method)
+
+        cmd = 'mysqldump {} {} --column-statistics=0 --add-drop-table {}'.format(db_name, shlex.quote(table) if table else '', credentials)
+
         try:
             # Dump MySQL
-            cmd = 'mysqldump {} --column-statistics=0 --add-drop-table -h {} -P {} -u {} -p{} > {}/{}.sql'.format(db_name, db_host, db_port, db_user, db_pass, path_to, filename)
-            subprocess.run([cmd], shell=True, check=True, capture_output=True)
+            compression.pipe_to_file(cmd, destination, method, self.config.get('compression_level'), self.config.get('compression_threads'))
         except subprocess.CalledProcessError as err:
             raise Exception('Error dumping: {} STDOUT: {})'.format(err.stderr.decode('utf-8'), err.stdout.decode('utf-8'))) from err
+
+        self.metrics.add('bytes', os.path.getsize(destination))
+        self.metrics.add('files')
+
+        return destination
+
+    def dump_tables(self, db_name, credentials, path):
+        """
+        Dump tables concurrently into a folder and describe them in a manifest.
+
+        Note that tables are not dumped from one consistent snapshot.
+
+        @param string db_name
+        @param string credentials
+        @param string path
+        """
+        tables = self.get_tables(db_name, credentials)
+        started = datetime.now().isoformat()
+
+        util.create_folder(path)
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.config.get('parallel_tables')) as executor:
+                files = list(executor.map(lambda table: self.dump(db_name, credentials, os.path.join(path, self.get_filename(table)), table), tables))
+        except Exception:
+            # Without all tables and the manifest this is no version to keep
+            util.remove(path)
+            raise
+
+        manifest = {
+            'database': db_name,
+            'compression': self.config.get('compression') or 'none',
+            'started': started,
+            'finished': datetime.now().isoformat(),
+            'tables': [{
+                'name': table,
+                'file': os.path.basename(file),
+                'size': os.path.getsize(file)
+            } for table, file in zip(tables, files)]
+        }
+
+        with open(os.path.join(path, 'manifest.json'), 'w') as fout:
+            fout.write(json.dumps(manifest, indent=4))
+
+    def get_filename(self, table):
+        """
+        Get safe filename for table.
+
+        Names that had to be changed get a checksum, so they can't clash.
+
+        @param string table
+        @return string
+        """
+        filename = re.sub(r'[^\w.-]', '_', table).lstrip('.')
+
+        if filename != table:
+            filename += '_' + util.md5(table)[:8]
+
+        return filename
+
+    def get_tables(self, db_name, credentials):
+        """
+        Get names of all tables in database.
+
+        @param string db_name
+        @param string credentials
+        @return list
+        """
+        try:
+            cmd = 'mysql {} -N -B {} -e "SHOW TABLES"'.format(db_name, credentials)
+            res = subprocess.run([cmd], shell=True, check=True, capture_output=True)
+        except subprocess.CalledProcessError as err:
+            raise Exception('Error listing tables: {} STDOUT: {})'.format(err.stderr.decode('utf-8'), err.stdout.decode('utf-8'))) from err
+
+        return [table for table in res.stdout.decode('utf-8').splitlines() if table]
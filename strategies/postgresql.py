@@ -1,5 +1,6 @@
 """Backup strategy for PostgreSQL."""
 
+import os
 import subprocess
 import re
 
@@ -35,10 +36,21 @@ class PostgreSQL(Strategy):
         # Determine filename
         filename = self.alias + '_' + util.startup_time
 
+        # Number of tables to dump in parallel
+        jobs = self.config.get('jobs', 1)
+
         try:
             # Dump database using pg_dump
-            cmd = 'pg_dump -Fc postgresql://{}:{}@{}:{}/{} -f {}/{}.dump'.format(db_user, db_pass, db_host, db_port, db_name, path_to, filename)
-
-            subprocess.run([cmd], shell=True, check=True, capture_output=True)
+            if jobs > 1:
+                # Directory format is the only one supporting parallel dumps
+                cmd = 'pg_dump -Fd -j {} postgresql://{}:{}@{}:{}/{} -f {}/{}'.format(jobs, db_user, db_pass, db_host, db_port, db_name, path_to, filename)
+            else:
+                cmd = 'pg_dump -Fc postgresql://{}:{}@{}:{}/{} -f {}/{}.dump'.format(db_user, db_pass, db_host, db_port, db_name, path_to, filename)
+
+            with self.phase('dump'):
+                subprocess.run([cmd], shell=True, check=True, capture_output=True)
         except subprocess.CalledProcessError as err:
             raise Exception('Error dumping: {} STDOUT: {})'.format(err.stderr.decode('utf-8'), err.stdout.decode('utf-8'))) from err
+
+        self.metrics.add('bytes', util.get_size(os.path.join(path_to, filename + ('' if jobs > 1 else '.dump'))))
+        self.metrics.add('files')
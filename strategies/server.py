@@ -3,9 +3,10 @@
 import os
 import subprocess
 import re
-import shutil
 
 from helpers import util
+from helpers import archive
+from helpers import compression
 from helpers.strategy import Strategy
 
 class Server(Strategy):
@@ -17,10 +18,11 @@ class Server(Strategy):
         """
         Start backup.
         """
-        if self.config.get('archive'):
-            self.archive(self.config.get('ssh_host'), self.config.get('ssh_user'), self.config.get('ssh_pass'), self.config.get('path'), self.backup_path, self.config.get('exclude'), self.config.get('remote_zip'))
-        else:
-            self.sync(self.config.get('ssh_host'), self.config.get('ssh_user'), self.config.get('ssh_pass'), self.config.get('path'), self.config.get('exclude'))
+        with self.phase('transfer'):
+            if self.config.get('archive'):
+                self.archive(self.config.get('ssh_host'), self.config.get('ssh_user'), self.config.get('ssh_pass'), self.config.get('path'), self.backup_path, self.config.get('exclude'), self.config.get('remote_zip'))
+            else:
+                self.sync(self.config.get('ssh_host'), self.config.get('ssh_user'), self.config.get('ssh_pass'), self.config.get('path'), self.config.get('exclude'))
 
     def sync(self, host, user, password, path_from, exclude=[]):
         """
@@ -36,13 +38,49 @@ class Server(Strategy):
         password = re.escape(password)
         exclude_str = ' '.join(list(map(lambda x: "--exclude '" + x + "'", exclude)))
 
+        # Hardlink unchanged files to the previous version
+        previous = self.get_previous_version() if self.config.get('snapshot') else None
+
+        if previous:
+            self.logger.info('Creating snapshot based on {}'.format(previous))
+            exclude_str += " --link-dest '{}'".format(previous)
+
         # Sync using rsync
-        cmd = "sshpass -p {} rsync -a {} -e 'ssh -o StrictHostKeyChecking=no' {}@{}:{}/ {}/".format(password, exclude_str, user, host, path_from, self.backup_path)
-        subprocess.run([cmd], shell=True)
+        cmd = "sshpass -p {} rsync -a --stats {} -e 'ssh -o StrictHostKeyChecking=no' {}@{}:{}/ {}/".format(password, exclude_str, user, host, path_from, self.backup_path)
+        res = subprocess.run([cmd], shell=True, stdout=subprocess.PIPE)
+
+        # Count what has actually been transferred
+        stats = res.stdout.decode('utf-8')
+        transferred = re.search(r'Total transferred file size: ([\d,.]+)', stats)
+        files = re.search(r'Number of regular files transferred: ([\d,.]+)', stats)
+
+        if transferred:
+            self.metrics.add('bytes', int(re.sub(r'\D', '', transferred.group(1))))
+
+        if files:
+            self.metrics.add('files', int(re.sub(r'\D', '', files.group(1))))
+
+        # rsync copies the remote folder's mtime, which versions are sorted by
+        os.utime(self.backup_path)
+
+    def get_previous_version(self):
+        """
+        Get the latest version folder other than the current one.
+
+        @return string Absolute path or None
+        """
+        if not self.config.get('versions') or self.config.get('versions') < 2:
+            return None
+
+        for version in util.get_versions(self.config.get('backup_path'), self.alias):
+            if os.path.isdir(version) and not os.path.islink(version) and os.path.abspath(version) != os.path.abspath(self.backup_path):
+                return os.path.abspath(version)
+
+        return None
 
     def archive(self, host, user, password, path_from, path_to, exclude=[], remote_zip=False):
         """
-        Download files to tmp using rsync and creates a zip archive from it.
+        Download files to tmp using rsync and creates an archive from it.
 
         @param string host
         @param string user
@@ -75,8 +113,13 @@ class Server(Strategy):
                 # Pull backups
                 cmd = "sshpass -p {} rsync --remove-source-files -a -e ssh {}@{}:{}/{}.zip {}/".format(password, user, host, path_from, filename, path_to)
                 subprocess.run([cmd], shell=True, check=True, capture_output=True)
+
+                self.metrics.add('bytes', os.path.getsize(os.path.join(path_to, filename + '.zip')))
+                self.metrics.add('files')
             except subprocess.CalledProcessError as err:
                 self.logger.error('Error pulling backups: {} STDOUT: {})'.format(err.stderr.decode('utf-8'), err.stdout.decode('utf-8')))
+        elif self.config.get('stream_archive'):
+            self.stream_archive(host, user, password, path_from, os.path.join(path_to, filename), exclude)
         else:
             try:
                 # Create temporary folder
@@ -93,4 +136,46 @@ class Server(Strategy):
 
             # Create archive from tmp
             destination = os.path.join(path_to, filename)
-            shutil.make_archive(destination, 'zip', tmp_path)
+            destination = archive.make_archive(destination, tmp_path, self.config.get('archive_format', 'zip'), self.config.get('compression_level'), self.config.get('compression_threads'))
+
+            self.metrics.add('bytes', os.path.getsize(destination))
+            self.metrics.add('files')
+
+    def stream_archive(self, host, user, password, path_from, destination, exclude=[]):
+        """
+        Stream tar from remote server through a compressor into the archive.
+
+        Uses the alias' archive_format, which has to be a tar format here.
+
+        @param string host
+        @param string user
+        @param string password Escaped password
+        @param string path_from
+        @param string destination Path without extension
+        @param list exclude
+        @raises Exception
+        """
+        fmt = self.config.get('archive_format', 'tar.gz')
+
+        if fmt not in archive.FORMATS or fmt == 'zip':
+            raise Exception('Archive format "{}" can\'t be streamed, use tar, tar.gz or tar.zst'.format(fmt))
+
+        destination += archive.get_extension(fmt)
+
+        # Determine remote parent and basename
+        parent, basename = os.path.split(path_from.rstrip('/'))
+
+        # Build exclude string
+        exclude_str = ' '.join(["--exclude '" + x.rstrip('/') + "'" for x in exclude])
+
+        # GNU tar exits with 1 if files changed while being read, which is routine on live servers
+        cmd = "sshpass -p {} ssh {}@{} -o StrictHostKeyChecking=no \"tar --warning=no-file-changed -C {} -cf - {} {}; test \\$? -le 1\"".format(password, user, host, parent or '/', exclude_str, basename)
+
+        try:
+            compression.pipe_to_file(cmd, destination, archive.FORMATS[fmt], self.config.get('compression_level'), self.config.get('compression_threads'))
+        except subprocess.CalledProcessError as err:
+            self.logger.error('Error streaming archive: {} STDOUT: {})'.format(err.stderr.decode('utf-8'), err.stdout.decode('utf-8')))
+            return
+
+        self.metrics.add('bytes', os.path.getsize(destination))
+        self.metrics.add('files')
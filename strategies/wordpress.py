@@ -39,7 +39,7 @@ class Wordpress(Strategy):
         Start backup.
         """
         # Backup database
-        self.mysql.backup(self.alias, True)
+        self.metrics.merge(self.mysql.backup(self.alias, True)['metrics'])
 
         # Backup files
-        self.server.backup(self.alias, True)
+        self.metrics.merge(self.server.backup(self.alias, True)['metrics'])